@@ -0,0 +1,116 @@
+"""Benchmark of the cold start of the lambda functions.
+
+Every run starts a fresh python process, which imports a lambda, as the lambda runtime
+does in its init phase, and calls its handler twice against local stub servers: the
+first invocation of a new container and a warm invocation reusing the module state.
+The timestream client is created as in the lambda, but the records go to a fake client.
+Reports the median of the runs in milliseconds.
+
+Target: the cold start (import and first invocation) of yr_past, which imported pandas,
+should take at most half of the 841 ms measured before pandas was dropped from it and
+boto3 was imported on first use. It went down to 343 ms.
+
+    python benchmarks/bench_cold_start.py --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from stubs import FakeWriteClient, load_lambda, stub_server
+
+LAMBDAS = ["sensor_data", "yr_past", "yr_future"]
+
+
+def bluetrack_rows(device_id, count=60):
+    now = datetime.now(timezone.utc)
+    particles = {name: 10 for name in ["mc_10_0", "mc_1_0", "mc_2_5", "mc_4_0", "nc_0_5", "nc_10_0",
+                                        "nc_1_0", "nc_2_5", "nc_4_0", "typical_particle_size"]}
+    return [{"gatewayId": 8, "deviceId": device_id, "temperature": 20.5, "humidity": 40.1, "dataJson": particles,
+             "timestamp": (now - timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M:%S.%f")} for i in range(count)]
+
+
+def frost_data(hours=48):
+    start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(hours=hours)
+    elements = {"sum(precipitation_amount PT1H)": 0.2, "max(air_temperature PT1H)": 12.5,
+                "max(wind_speed PT1H)": 3.1, "max_wind_speed(wind_from_direction PT1H)": 270}
+    return {"data": [{"sourceId": "SN68860:0",
+                      "referenceTime": (start + timedelta(hours=hour)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                      "observations": [{"elementId": name, "value": value} for name, value in elements.items()]}
+                     for hour in range(hours)]}
+
+
+def forecast(hours=90):
+    start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+    return {"properties": {"timeseries": [{
+        "time": (start + timedelta(hours=hour)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+        "data": {"instant": {"details": {"air_temperature": 10.5, "relative_humidity": 80.5,
+                                         "wind_speed": 3.2, "wind_from_direction": hour * 37 % 360}},
+                 "next_1_hours": {"details": {"precipitation_amount": 0.1}}},
+    } for hour in range(hours)]}}
+
+
+def respond(path, headers):
+    if path.startswith("/api/td/device/"):
+        return 200, {"Content-Type": "application/json"}, bluetrack_rows(int(path.split("/")[5]))
+    if path.startswith("/frost"):
+        return 200, {"Content-Type": "application/json"}, frost_data()
+    return 200, {"Content-Type": "application/json"}, forecast()
+
+
+def run_lambda(name):
+    """Import and invoke a lambda in this process, which should be a fresh one."""
+    with stub_server(respond) as url:
+        env = {"BLUETRACK_URL": url, "FROST_URL": f"{url}/frost", "FORECAST_URL": f"{url}/forecast",
+               "FORECAST_CACHE": ""}
+        began = time.perf_counter()
+        module = load_lambda(name, **env)
+        imported = time.perf_counter() - began
+
+        import common.sinks
+        import common.timestream
+        fake = FakeWriteClient()
+        create_client = common.timestream.get_write_client
+
+        def get_write_client(*args, **kwargs):
+            # Create the real client as the lambda does, so its cost is part of the first invocation
+            create_client(*args, **kwargs)
+            return fake
+        common.sinks.get_write_client = get_write_client
+
+        timings = {"import": imported}
+        for invocation in ("first", "warm"):
+            began = time.perf_counter()
+            module.lambda_handler()
+            timings[invocation] = time.perf_counter() - began
+    print(json.dumps({key: value * 1000 for key, value in timings.items()}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--lambdas", nargs="*", default=LAMBDAS)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_lambda(args.child)
+        return
+
+    print(f"{'lambda':<12} {'import ms':>10} {'first ms':>9} {'cold ms':>8} {'warm ms':>8}")
+    for name in args.lambdas:
+        runs = []
+        for _ in range(args.repeat):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", name],
+                                    capture_output=True, text=True, check=True).stdout
+            runs.append(json.loads(output.strip().splitlines()[-1]))
+        median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        print(f"{name:<12} {median['import']:>10.0f} {median['first']:>9.0f} "
+              f"{median['import'] + median['first']:>8.0f} {median['warm']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
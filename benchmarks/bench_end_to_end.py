@@ -0,0 +1,234 @@
+"""End to end benchmark of the lambda handlers, the backfill and the query decoder against local stand-ins.
+
+A local server replays generated BlueTrack, Frost and locationforecast payloads, sized by
+the number of devices (or stations and positions) and days, after `--latency` seconds.
+The records are written to a fake timestream-write client, and the query scenario reads
+a fake timestream-query result of the same size. Every scenario and size runs in a fresh
+process, which makes one warm up invocation and then `--repeat` measured invocations.
+
+Reports the records per second, the p50 and p99 latency of an invocation and the peak RSS
+of the process. `--output` saves the results, and `--baseline` compares with saved results.
+
+    python benchmarks/bench_end_to_end.py --devices 1 10 50 --days 1 7 --output baseline.json
+    python benchmarks/bench_end_to_end.py --devices 1 10 50 --days 1 7 --baseline baseline.json
+
+The forecast of yr_future does not depend on the days, it runs once per number of positions.
+The rate limit of the hosts is raised, so the benchmark measures the lambdas, not the limit.
+"""
+import argparse
+import itertools
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import parse_qs, urlsplit
+
+from stubs import FakeQueryClient, FakeWriteClient, ROOT, load_lambda, stub_server, use_write_client
+
+SCENARIOS = ["sensor_data", "yr_past", "yr_future", "backfill", "query"]
+PARTICLES = ["mc_10_0", "mc_1_0", "mc_2_5", "mc_4_0", "nc_0_5", "nc_10_0", "nc_1_0", "nc_2_5", "nc_4_0",
+             "typical_particle_size"]
+FROST_ELEMENTS = ["sum(precipitation_amount PT1H)", "max(air_temperature PT1H)", "max(wind_speed PT1H)",
+                  "max_wind_speed(wind_from_direction PT1H)"]
+
+
+class Upstream:
+    """Answers BlueTrack, Frost and locationforecast requests with generated payloads.
+
+    :param days: days of hourly observations per Frost station
+    :param interval: minutes between the rows of a BlueTrack device
+    :param latency: seconds waited before each answer
+    """
+
+    def __init__(self, days, interval, latency):
+        self.days = days
+        self.interval = interval
+        self.latency = latency
+
+    def __call__(self, path, headers):
+        time.sleep(self.latency)
+        url = urlsplit(path)
+        if url.path.startswith("/api/td/device/"):
+            parts = url.path.split("/")
+            body = self.bluetrack(int(parts[5]), parts[7], parts[8])
+        elif url.path.startswith("/frost"):
+            body = self.frost(parse_qs(url.query)["sources"][0].split(","))
+        else:
+            body = self.forecast()
+        return 200, {"Content-Type": "application/json"}, body
+
+    def bluetrack(self, device_id, start, end):
+        start = datetime.strptime(start, "%Y-%m-%dT%H:%M")
+        minutes = int((datetime.strptime(end, "%Y-%m-%dT%H:%M") - start).total_seconds() // 60)
+        return [{"gatewayId": 8, "deviceId": device_id, "temperature": 20.5 + i % 7, "humidity": 40.1,
+                 "dataJson": {name: i % 100 for name in PARTICLES},
+                 "timestamp": (start + timedelta(minutes=i)).strftime("%Y-%m-%dT%H:%M:%S.%f")}
+                for i in range(0, minutes, self.interval)]
+
+    def frost(self, sources):
+        start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0) - timedelta(days=self.days)
+        return {"data": [{"sourceId": f"{source}:0",
+                          "referenceTime": (start + timedelta(hours=hour)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                          "observations": [{"elementId": element, "value": round(hour * 1.7 % 360, 1)}
+                                           for element in FROST_ELEMENTS]}
+                         for source in sources for hour in range(self.days * 24)]}
+
+    def forecast(self, hours=90):
+        start = datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+        return {"properties": {"timeseries": [{
+            "time": (start + timedelta(hours=hour)).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            "data": {"instant": {"details": {"air_temperature": 10.5, "relative_humidity": 80.5,
+                                             "wind_speed": 3.2, "wind_from_direction": hour * 37 % 360}},
+                     "next_1_hours": {"details": {"precipitation_amount": 0.1}}},
+        } for hour in range(hours)]}}
+
+
+def lambda_env(url, config):
+    return {"BLUETRACK_URL": url, "FROST_URL": f"{url}/frost", "FORECAST_URL": f"{url}/forecast",
+            "FORECAST_CACHE": "", "REQUESTS_PER_SECOND": "100000", "METRICS_FORMAT": "off",
+            "TIME_DELTA": str(config["days"] * 1440)}
+
+
+def sensors(sensor_data, devices):
+    """Devices alternating between the schemas of sensor_data.json, with their compiled plans."""
+    schemas = [sensor["data"] for sensor, _ in sensor_data.load_sensors()]
+    devices = [{"id": 1000 + i, "data": schemas[i % len(schemas)]} for i in range(devices)]
+    return [(sensor, sensor_data.compile_schema(sensor["data"])) for sensor in devices]
+
+
+def setup_sensor_data(url, config):
+    sensor_data = load_lambda("sensor_data", **lambda_env(url, config))
+    sensor_data._sensors = sensors(sensor_data, config["devices"])
+    return sensor_data.lambda_handler
+
+
+def setup_yr_past(url, config):
+    yr_past = load_lambda("yr_past", **lambda_env(url, config))
+    yr_past._positions = [{"name": f"station {i}", "lat": 63.4 + i / 1000, "lon": 10.4, "gatewayId": i,
+                           "measureStation": f"SN{10000 + i}"} for i in range(config["devices"])]
+    return yr_past.lambda_handler
+
+
+def setup_yr_future(url, config):
+    yr_future = load_lambda("yr_future", **lambda_env(url, config))
+    yr_future._positions = [{"name": f"position {i}", "lat": 63.4 + i / 100, "lon": 10.4, "gatewayId": i}
+                            for i in range(config["devices"])]
+    return yr_future.lambda_handler
+
+
+def setup_backfill(url, config):
+    sensor_data = load_lambda("sensor_data", **lambda_env(url, config))
+    sensor_data._sensors = sensors(sensor_data, config["devices"])
+    # The backfill imports the lambda as lambda_function
+    sys.modules["lambda_function"] = sensor_data
+    import backfill
+
+    end = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    start = end - timedelta(days=config["days"])
+    directory = tempfile.mkdtemp()
+    runs = itertools.count()
+
+    def run():
+        # A new checkpoint for every run, else the later runs find nothing to backfill
+        backfill.backfill(start, end, checkpoint_path=os.path.join(directory, f"checkpoint-{next(runs)}.json"))
+    return run
+
+
+def setup_query(url, config):
+    sys.path.insert(0, os.path.join(ROOT, "yr_future_from_csv"))
+    import timestreamquery
+    from bench_query_decode import make_pages
+
+    rows = config["devices"] * config["days"] * 1440 // config["interval"]
+    query_client = FakeQueryClient(lambda query: make_pages(rows), latency=config["latency"])
+
+    def run():
+        df = timestreamquery.executeQueryAndReturnAsDataframe(query_client, "SELECT * FROM db.table", False)
+        return len(df)
+    return run
+
+
+SETUPS = {"sensor_data": setup_sensor_data, "yr_past": setup_yr_past, "yr_future": setup_yr_future,
+          "backfill": setup_backfill, "query": setup_query}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[max(0, min(len(values) - 1, math.ceil(len(values) * fraction) - 1))]
+
+
+def run_child(config):
+    """Run a scenario in this process, which should be a fresh one, and print its result as json."""
+    client = FakeWriteClient(latency=config["write_latency"], keep=False)
+    with stub_server(Upstream(config["days"], config["interval"], config["latency"])) as url:
+        run = SETUPS[config["scenario"]](url, config)
+        use_write_client(client)
+        run()
+        latencies = []
+        records = 0
+        for _ in range(config["repeat"]):
+            written = client.written
+            began = time.perf_counter()
+            rows = run()
+            latencies.append(time.perf_counter() - began)
+            records += rows if rows is not None else client.written - written
+    print(json.dumps({**config, "records": records // config["repeat"],
+                      "records_per_second": records / sum(latencies),
+                      "p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99),
+                      # ru_maxrss is in kilobytes on linux
+                      "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenarios", nargs="*", default=SCENARIOS, choices=SCENARIOS)
+    parser.add_argument("--devices", type=int, nargs="*", default=[1, 10, 50],
+                        help="devices, stations or positions")
+    parser.add_argument("--days", type=int, nargs="*", default=[1, 7])
+    parser.add_argument("--interval", type=int, default=5, help="minutes between the rows of a device")
+    parser.add_argument("--latency", type=float, default=0.01, help="seconds before each answer or query page")
+    parser.add_argument("--write-latency", type=float, default=0.01, help="seconds of each write_records call")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", help="save the results as json")
+    parser.add_argument("--baseline", help="compare the records per second with saved results")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_child(json.loads(args.child))
+        return
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = {(r["scenario"], r["devices"], r["days"]): r for r in json.load(file)}
+    print(f"{'scenario':<12} {'devices':>7} {'days':>5} {'records':>9} {'records/s':>10} {'p50 s':>7} "
+          f"{'p99 s':>7} {'rss MB':>7}" + (f" {'vs base':>8}" if baseline else ""))
+    results = []
+    for scenario in args.scenarios:
+        for devices in args.devices:
+            for days in args.days[:1] if scenario == "yr_future" else args.days:
+                config = {"scenario": scenario, "devices": devices, "days": days, "interval": args.interval,
+                          "latency": args.latency, "write_latency": args.write_latency, "repeat": args.repeat}
+                output = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", json.dumps(config)],
+                                        capture_output=True, text=True, check=True).stdout
+                result = json.loads(output.strip().splitlines()[-1])
+                results.append(result)
+                line = (f"{scenario:<12} {devices:>7} {days:>5} {result['records']:>9} "
+                        f"{result['records_per_second']:>10.0f} {result['p50']:>7.3f} {result['p99']:>7.3f} "
+                        f"{result['peak_rss_mb']:>7.0f}")
+                base = baseline.get((scenario, devices, days))
+                if base:
+                    line += f" {result['records_per_second'] / base['records_per_second']:>7.2f}x"
+                print(line, flush=True)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Benchmark of yr_future fetching forecasts for many gateways against a local stub server.
+
+Runs the handler for an increasing number of gateways, with every gateway at its own
+position, and reports how the run time grows. The conversion of a forecast into
+measures is checked against the original `get_measurement` per hour.
+
+    python benchmarks/bench_forecast.py --latency 0.1 --counts 10 100 300
+"""
+import argparse
+import json
+import math
+import time
+
+from stubs import FakeWriteClient, load_lambda, stub_server, use_write_client
+
+
+def make_forecast(hours=90):
+    return {"properties": {"timeseries": [{
+        "time": f"2022-10-01T{hour % 24:02d}:00:00Z",
+        "data": {
+            "instant": {"details": {"air_temperature": 10 + hour % 7, "relative_humidity": 80.5,
+                                    "wind_speed": 3.2, "wind_from_direction": (hour * 37) % 360}},
+            "next_1_hours": {"details": {"precipitation_amount": 0.1 * (hour % 3)}},
+        },
+    } for hour in range(hours)]}}
+
+
+def get_measurement(data, time_delta: int):
+    '''The original conversion of a single hour of the forecast.'''
+    measurements = []
+    for name in ["air_temperature", "relative_humidity", "wind_speed"]:
+        measurements.append({"Name": f"{time_delta}h_{name}", "Value": str(data["data"]["instant"]["details"][name]), "Type": "DOUBLE"})
+    wind_direction = float(data["data"]["instant"]["details"]["wind_from_direction"])
+    measurements.append({"Name": f"{time_delta}h_wind_direction_cos", "Value": str(math.cos(math.radians(wind_direction))), "Type": "DOUBLE"})
+    measurements.append({"Name": f"{time_delta}h_wind_direction_sin", "Value": str(math.sin(math.radians(wind_direction))), "Type": "DOUBLE"})
+    measurements.append({"Name": f"{time_delta}h_percipitation", "Value": str(data["data"]["next_1_hours"]["details"]["precipitation_amount"]), "Type": "DOUBLE"})
+    return measurements
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.1, help="seconds the stub waits per request")
+    parser.add_argument("--counts", type=int, nargs="*", default=[10, 50, 200])
+    parser.add_argument("--max-in-flight", type=int, default=10)
+    args = parser.parse_args()
+
+    forecast = make_forecast()
+    body = json.dumps(forecast).encode()
+
+    def respond(path, headers):
+        time.sleep(args.latency)
+        return 200, {"Content-Type": "application/json"}, body
+
+    with stub_server(respond) as url:
+        yr_future = load_lambda("yr_future", FORECAST_URL=url, FORECAST_CACHE="", REQUESTS_PER_SECOND="1000",
+                                MAX_IN_FLIGHT=str(args.max_in_flight))
+        expected = [m for i, data in enumerate(forecast["properties"]["timeseries"][:24]) for m in get_measurement(data, i + 1)]
+        record = next(yr_future.extract_forecast_records(yr_future.forecast_to_measure_values(forecast), 63, 10.4, 1, 0))
+        assert record.to_boto()["MeasureValues"] == expected
+
+        print(f"{'gateways':>8} {'seconds':>8}")
+        for count in args.counts:
+            client = FakeWriteClient()
+            use_write_client(client)
+            # The positions are loaded once per container, replace them for every count
+            yr_future._positions = [{"name": f"gateway_{i}", "lat": 63 + i / 1000, "lon": 10.4, "gatewayId": i}
+                                    for i in range(count)]
+            start = time.perf_counter()
+            yr_future.fetch_and_insert_sensor_data()
+            print(f"{count:>8} {time.perf_counter() - start:>8.3f}")
+            assert len(client.stored) == count, f"{len(client.stored)} records written for {count} gateways"
+
+
+if __name__ == "__main__":
+    main()
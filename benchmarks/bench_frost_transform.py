@@ -0,0 +1,124 @@
+"""Benchmark of the yr_past transform of FROST observations into records.
+
+Compares the original transform, pivoting the observations into a pandas frame and
+iterating it with `iterrows` and a `get_measurement` call per row, with the pivot into
+plain rows on a synthetic multi-station, multi-month payload, and checks that both give
+the same values (the original also wrote missing values as "nan", which are ignored).
+
+    python benchmarks/bench_frost_transform.py --stations 5 --days 90
+"""
+import argparse
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from stubs import load_lambda
+
+ELEMENTS = ["sum(precipitation_amount PT1H)", "max(air_temperature PT1H)", "max(wind_speed PT1H)",
+            "max_wind_speed(wind_from_direction PT1H)"]
+
+
+def make_payload(stations, days, missing_rate=0.05, seed=0):
+    rng = random.Random(seed)
+    start = datetime(2022, 7, 1)
+    data = []
+    for station in range(stations):
+        for hour in range(days * 24):
+            observations = [{"elementId": element, "value": round(rng.uniform(0, 360), 1)}
+                            for element in ELEMENTS if rng.random() > missing_rate]
+            data.append({
+                "sourceId": f"SN{68860 + station}:0",
+                "referenceTime": (start + timedelta(hours=hour)).strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+                "observations": observations,
+            })
+    return data
+
+
+def frost_to_frame(data):
+    '''The original pivot of the observations into a frame.'''
+    df = pd.json_normalize(data, record_path=['observations'], meta='referenceTime')
+    df = df[['referenceTime', 'value', 'elementId']].rename(columns={'referenceTime': 'timestamp'})
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    df = df.pivot(index='timestamp', columns='elementId', values='value').reset_index()
+    df.set_index('timestamp', inplace=True)
+    return df
+
+
+def get_measurement(data: pd.Series):
+    '''The original per row measurement builder.'''
+    measurements = []
+    for name in data.index:
+        if name != "max_wind_speed(wind_from_direction PT1H)":
+            if data.name != np.nan:
+                measurements.append({"Name": name, "Value": str(data[name]), "Type": "DOUBLE"})
+    if "max_wind_speed(wind_from_direction PT1H)" in data.index:
+        wind_direction = float(data["max_wind_speed(wind_from_direction PT1H)"])
+        if wind_direction != np.nan:
+            measurements.append({"Name": "wind_direction_cos", "Value": str(math.cos(math.radians(wind_direction))), "Type": "DOUBLE"})
+            measurements.append({"Name": "wind_direction_sin", "Value": str(math.sin(math.radians(wind_direction))), "Type": "DOUBLE"})
+    return measurements
+
+
+def original_transform(data, lat, lon, gateway_id):
+    '''The original iterrows based record builder.'''
+    df = frost_to_frame(data)
+    records = []
+    for timestamp, row in df.iterrows():
+        measure_values = get_measurement(data=row)
+        record = {
+            'Dimensions': [
+                {'Name': 'lat', 'Value': str(lat)},
+                {'Name': 'lon', 'Value': str(lon)},
+                {'Name': 'gateway_id', 'Value': str(gateway_id)},
+            ],
+            'Time': str(int(timestamp.timestamp()*1000)),
+            'MeasureName': 'yr_past',
+            'MeasureValueType': 'MULTI',
+            'MeasureValues': measure_values
+        }
+        if len(measure_values) != 0:
+            records.append(record)
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, default=5)
+    parser.add_argument("--days", type=int, default=90)
+    args = parser.parse_args()
+
+    yr_past = load_lambda("yr_past")
+    payload = make_payload(args.stations, args.days)
+    by_station = {}
+    for item in payload:
+        by_station.setdefault(item["sourceId"], []).append(item)
+    rows = len(payload)
+
+    timings = {}
+    results = {}
+    def rows_transform(data, *args):
+        return [record.to_boto() for record in yr_past.extract_frost_records(yr_past.frost_to_rows(data), *args)]
+
+    for name, transform in (("iterrows", original_transform), ("rows", rows_transform)):
+        start = time.perf_counter()
+        results[name] = [record for data in by_station.values() for record in transform(data, 63.44, 10.43, 8)]
+        timings[name] = time.perf_counter() - start
+
+    assert len(results["iterrows"]) == len(results["rows"])
+    for original, columnar in zip(results["iterrows"], results["rows"]):
+        assert original["Time"] == columnar["Time"]
+        expected = [(m["Name"], float(m["Value"])) for m in original["MeasureValues"] if m["Value"] != "nan"]
+        assert expected == [(m["Name"], float(m["Value"])) for m in columnar["MeasureValues"]]
+
+    print(f"{rows} rows from {args.stations} stations over {args.days} days")
+    print(f"{'transform':<10} {'seconds':>8} {'rows/s':>10}")
+    for name, elapsed in timings.items():
+        print(f"{name:<10} {elapsed:>8.3f} {rows / elapsed:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
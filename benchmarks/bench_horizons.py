@@ -0,0 +1,86 @@
+"""Benchmark of building the wind direction horizon columns of the CSV forecast merge.
+
+Compares the original notebook loop, assigning every horizon of every row with
+`df.loc`, with `horizons.shift_horizons` on hourly rows spanning the times of
+`WeatherForecast.csv` scaled up. The loop is only timed on the first rows, as it
+takes minutes on the full frame. The check documents the off by one of the loop:
+its horizon h+1 holds the value h rows later, which shift_horizons puts in horizon h.
+
+    python benchmarks/bench_horizons.py --scale 100 --original-rows 500
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from stubs import ROOT
+
+sys.path.insert(0, os.path.join(ROOT, "yr_future_from_csv"))
+from horizons import HORIZONS, shift_horizons  # noqa: E402
+
+COLUMNS = ["wind_direction_sin", "wind_direction_cos"]
+
+
+def make_frame(scale, seed=0):
+    csv = pd.read_csv(os.path.join(ROOT, "yr_future_from_csv", "WeatherForecast.csv"), usecols=["time"])
+    start = pd.to_datetime(csv.time.iloc[0]).tz_localize(None)
+    rows = len(csv) * scale
+    direction = np.random.default_rng(seed).uniform(0, 2 * np.pi, rows)
+    return pd.DataFrame({"time": pd.date_range(start, periods=rows, freq="1h"),
+                         "wind_direction_sin": np.sin(direction), "wind_direction_cos": np.cos(direction)})
+
+
+def original_horizons(df):
+    '''The original loop of the notebook, with float zeros as newer pandas no longer upcasts int columns.'''
+    for j in range(24):
+        df[f'{j+1}h_wind_direction_sin'] = 0.0
+        df[f'{j+1}h_wind_direction_cos'] = 0.0
+    for i in range(df.shape[0]-24):
+        for j in range(24):
+            df.loc[i, f'{j+1}h_wind_direction_sin'] = df.loc[i+j, 'wind_direction_sin']
+            df.loc[i, f'{j+1}h_wind_direction_cos'] = df.loc[i+j, 'wind_direction_cos']
+    df.drop(columns=['wind_direction_sin', 'wind_direction_cos'], inplace=True)
+    return df
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", type=int, default=100, help="times the rows of WeatherForecast.csv")
+    parser.add_argument("--original-rows", type=int, default=500, help="rows to run the original loop on")
+    args = parser.parse_args()
+
+    df = make_frame(args.scale)
+    rows = len(df)
+    original_rows = min(rows, args.original_rows)
+
+    begin = time.perf_counter()
+    original = original_horizons(df.iloc[:original_rows].copy())
+    original_elapsed = time.perf_counter() - begin
+    begin = time.perf_counter()
+    shifted = shift_horizons(df, COLUMNS)
+    shifted_elapsed = time.perf_counter() - begin
+
+    # Rows the loop filled, and horizons it computed, shifted by one
+    filled = original_rows - HORIZONS
+    for column in COLUMNS:
+        for horizon in range(1, HORIZONS):
+            expected = original[f"{horizon + 1}h_{column}"].to_numpy(dtype=np.float64)[:filled]
+            np.testing.assert_array_equal(shifted[f"{horizon}h_{column}"].to_numpy()[:filled], expected)
+    # The value of the last horizon is the next row after the loop's last horizon, and the edge rows are NaN
+    np.testing.assert_array_equal(shifted[f"{HORIZONS}h_{COLUMNS[0]}"].to_numpy()[:rows - HORIZONS],
+                                  df[COLUMNS[0]].to_numpy()[HORIZONS:])
+    assert shifted[f"{HORIZONS}h_{COLUMNS[0]}"].iloc[rows - HORIZONS:].isna().all()
+    assert shifted[f"1h_{COLUMNS[0]}"].iloc[:rows - 1].notna().all()
+
+    print(f"{rows} rows, {HORIZONS} horizons of {len(COLUMNS)} columns")
+    print(f"{'builder':<10} {'rows':>8} {'seconds':>8} {'rows/s':>10}")
+    print(f"{'loop':<10} {original_rows:>8} {original_elapsed:>8.3f} {original_rows / original_elapsed:>10.0f}")
+    print(f"{'shift':<10} {rows:>8} {shifted_elapsed:>8.3f} {rows / shifted_elapsed:>10.0f}")
+    print(f"the loop would take about {original_elapsed * rows / original_rows:.0f} s on all rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Benchmark of decoding timestream query results into dataframes.
+
+Compares the original decoder, collecting every page and calling `parseDatum` for
+each cell, with the streaming decoder of `timestreamquery`, which converts a page at
+a time with converters chosen once per column. Checks that both give the same frame,
+and measures the peak memory of reading the whole result as a stream of page frames.
+
+    python benchmarks/bench_query_decode.py --rows 200000
+"""
+import argparse
+import sys
+import os
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from stubs import ROOT, FakeQueryClient
+
+sys.path.insert(0, os.path.join(ROOT, "yr_future_from_csv"))
+import timestreamquery  # noqa: E402
+
+COLUMN_INFO = [
+    {"Name": "gateway_id", "Type": {"ScalarType": "VARCHAR"}},
+    {"Name": "measure_name", "Type": {"ScalarType": "VARCHAR"}},
+    {"Name": "time", "Type": {"ScalarType": "TIMESTAMP"}},
+    {"Name": "wind_direction_sin", "Type": {"ScalarType": "DOUBLE"}},
+    {"Name": "wind_direction_cos", "Type": {"ScalarType": "DOUBLE"}},
+    {"Name": "count", "Type": {"ScalarType": "BIGINT"}},
+]
+
+
+def make_pages(rows, rows_per_page=1000):
+    start = datetime(2022, 9, 1)
+    for page_start in range(0, rows, rows_per_page):
+        page_rows = []
+        for i in range(page_start, min(rows, page_start + rows_per_page)):
+            page_rows.append({"Data": [
+                {"ScalarValue": str(i % 10)},
+                {"ScalarValue": "yr_past"},
+                {"ScalarValue": (start + timedelta(minutes=i)).strftime("%Y-%m-%d %H:%M:%S.000000000")},
+                {"ScalarValue": str((i % 360) / 360)} if i % 50 else {"NullValue": True},
+                {"ScalarValue": str(1 - (i % 360) / 360)},
+                {"ScalarValue": str(i)},
+            ]})
+        yield {"QueryId": "query", "ColumnInfo": COLUMN_INFO, "Rows": page_rows}
+
+
+def original_decode(items):
+    '''The original decoder of timestreamquery.flatModelToDataframe.'''
+    return_val = defaultdict(list)
+    for obj in items:
+        for row in obj.get('Rows'):
+            for c_info, data in zip(obj['ColumnInfo'], row['Data']):
+                return_val[c_info['Name']].append(timestreamquery.parseDatum(c_info['Type'], data))
+    return pd.DataFrame(return_val)
+
+
+def peak_memory(read):
+    tracemalloc.start()
+    read()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    args = parser.parse_args()
+
+    pages = list(make_pages(args.rows))
+    decoders = (
+        ("original", lambda: original_decode(timestreamquery.executeQuery(FakeQueryClient(pages), "SELECT"))),
+        ("streaming", lambda: timestreamquery.executeQueryAndReturnAsDataframe(FakeQueryClient(pages), "SELECT")),
+    )
+    results = {}
+    print(f"{'decoder':<10} {'seconds':>8} {'rows/s':>10}")
+    for name, decode in decoders:
+        begin = time.perf_counter()
+        results[name] = decode()
+        elapsed = time.perf_counter() - begin
+        print(f"{name:<10} {elapsed:>8.3f} {args.rows / elapsed:>10.0f}")
+    pd.testing.assert_frame_equal(results["original"], results["streaming"])
+
+    del pages, results
+
+    # The pages are generated while they are read, so they are only kept alive by the decoder
+    def read_all():
+        original_decode(timestreamquery.executeQuery(FakeQueryClient(lambda query: make_pages(args.rows)), "SELECT"))
+
+    def read_stream():
+        for frame in timestreamquery.executeQueryAndIterateDataframes(
+                FakeQueryClient(lambda query: make_pages(args.rows)), "SELECT"):
+            pass
+
+    print(f"peak memory, original: {peak_memory(read_all) / 2**20:.1f} MiB, "
+          f"page frames: {peak_memory(read_stream) / 2**20:.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Benchmark of the memory held by the records of a sensor_data backfill.
+
+Extracts the records of a backfill of synthetic points, alternating between the
+temperature sensor (device 43) and the particle sensor (device 145), and measures
+with tracemalloc the memory of keeping all of them, as compact `Record` objects and
+as the boto3 dicts the records were built as before. Checks that both give the same
+records. The dicts take about 2 GB for a million points, so by default only a part
+of the points is extracted as dicts and their memory is scaled up to --points.
+
+    python benchmarks/bench_record_memory.py --points 1000000 --dict-points 200000
+"""
+import argparse
+import gc
+import tracemalloc
+
+from stubs import load_lambda
+
+
+def make_device_data(sensor, points, offset=0):
+    nested = "dataJson" in sensor["data"]
+    names = list(sensor["data"]["dataJson"] if nested else sensor["data"])
+    rows = []
+    for i in range(offset, offset + points):
+        values = {name: (i * 7 + n) % 1000 + 0.5 * (n % 2) for n, name in enumerate(names)}
+        rows.append({
+            "gatewayId": 8,
+            "deviceId": sensor["id"],
+            "timestamp": f"2022-{1 + i // 2419200 % 12:02d}-{1 + i // 86400 % 28:02d}T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.000000",
+            **({"dataJson": values} if nested else values),
+        })
+    return rows
+
+
+def extract(sensor_data, points, as_boto, chunk=50000):
+    """Extract the records of points split over the sensors, in chunks as the backfill fetches them."""
+    sensors = sensor_data.load_sensors()
+    records = []
+    for offset in range(0, points, chunk):
+        sensor, plan = sensors[offset // chunk % len(sensors)]
+        device_data = make_device_data(sensor, min(chunk, points - offset), offset)
+        extracted = sensor_data.extract_device_records(device_data, plan)
+        records += [record.to_boto() for record in extracted] if as_boto else extracted
+    return records
+
+
+def measure(sensor_data, points, as_boto):
+    gc.collect()
+    tracemalloc.start()
+    records = extract(sensor_data, points, as_boto)
+    held = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return records, held
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--points", type=int, default=1000000)
+    parser.add_argument("--dict-points", type=int, default=200000, help="points extracted as dicts")
+    args = parser.parse_args()
+
+    sensor_data = load_lambda("sensor_data")
+    compact, compact_bytes = measure(sensor_data, args.points, as_boto=False)
+    sample = [record.to_boto() for record in compact[:args.dict_points]]
+    del compact
+    dicts, dict_bytes = measure(sensor_data, args.dict_points, as_boto=True)
+    assert dicts == sample
+    del dicts, sample
+    dict_bytes = dict_bytes * args.points / args.dict_points
+
+    print(f"{args.points} points" + (f", dicts scaled from {args.dict_points}" if args.dict_points != args.points else ""))
+    print(f"{'records':<8} {'MiB held':>9} {'bytes/point':>12}")
+    print(f"{'dicts':<8} {dict_bytes / 2**20:>9.1f} {dict_bytes / args.points:>12.0f}")
+    print(f"{'Record':<8} {compact_bytes / 2**20:>9.1f} {compact_bytes / args.points:>12.0f}")
+    print(f"Record holds {compact_bytes / dict_bytes:.0%} of the memory of the dicts")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""Microbenchmark of the sensor_data record extraction.
+
+Compares the original extractor, which walks the nested schema for every row, with
+the compiled extraction plan on a synthetic payload for the particle sensor (device
+145, with its measurements nested in `dataJson`). Reports throughput and the memory
+allocated by tracemalloc while extracting.
+
+    python benchmarks/bench_schema_extract.py --rows 100000
+"""
+import argparse
+import gc
+import time
+import tracemalloc
+from datetime import datetime
+
+from stubs import load_lambda
+
+
+def get_measurement(data, schema):
+    '''The original recursive schema walk, run for every row.'''
+    measurements = []
+    for key, value in schema.items():
+        if isinstance(value, str):
+            measurements.append((key, data[key], value))
+        elif isinstance(value, dict):
+            measurements += get_measurement(data[key], value)
+        else:
+            raise ValueError
+    return measurements
+
+
+def extract_device_records_original(device_data, sensor_schema):
+    '''The original extractor, building new dimension and measure dicts for every row.'''
+    records = []
+    for data in device_data:
+        measure_values = []
+        measurements = get_measurement(data, sensor_schema)
+        for measurement in measurements:
+            measure_values.append({'Name': measurement[0], 'Value': str(measurement[1]), 'Type': measurement[2]})
+        record = {
+            'Dimensions': [
+                {'Name': 'gateway_id', 'Value': str(data['gatewayId'])},
+                {'Name': 'tagId', 'Value': str(data['deviceId'])},
+            ],
+            'Time': str(int(round(datetime.strptime(data['timestamp'], '%Y-%m-%dT%H:%M:%S.%f').timestamp()*1000))),
+            'MeasureName': 'sensor_measurements',
+            'MeasureValueType': 'MULTI',
+            'MeasureValues': measure_values
+        }
+        if len(measure_values) != 0:
+            records.append(record)
+    return records
+
+
+def make_payload(schema, rows):
+    names = list(schema["dataJson"])
+    return [{
+        "gatewayId": 8,
+        "deviceId": 145,
+        "timestamp": f"2022-10-{1 + i // 86400 % 28:02d}T{i // 3600 % 24:02d}:{i // 60 % 60:02d}:{i % 60:02d}.{i % 1000:03d}000",
+        "dataJson": {name: i % 97 + n for n, name in enumerate(names)},
+    } for i in range(rows)]
+
+
+def measure(extract, repeat=3):
+    # Timed without tracemalloc, as tracing slows down every allocation, and without
+    # the garbage collector, whose pauses depend on what earlier runs left in memory
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        gc.disable()
+        start = time.perf_counter()
+        records = list(extract())
+        timings.append(time.perf_counter() - start)
+        gc.enable()
+        del records
+    elapsed = min(timings)
+    tracemalloc.start()
+    records = list(extract())
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return records, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    sensor_data = load_lambda("sensor_data")
+    sensor, plan = next((sensor, plan) for sensor, plan in sensor_data.load_sensors() if sensor["id"] == 145)
+    payload = make_payload(sensor["data"], args.rows)
+
+    original, original_time, original_peak = measure(lambda: extract_device_records_original(payload, sensor["data"]))
+    compiled, compiled_time, compiled_peak = measure(lambda: sensor_data.extract_device_records(payload, plan))
+    assert original == [record.to_boto() for record in compiled]
+    del original, compiled
+
+    print(f"{'extractor':<10} {'seconds':>8} {'rows/s':>10} {'peak MiB':>9}")
+    for name, elapsed, peak in (("original", original_time, original_peak), ("compiled", compiled_time, compiled_peak)):
+        print(f"{name:<10} {elapsed:>8.3f} {args.rows / elapsed:>10.0f} {peak / 2**20:>9.1f}")
+
+
+if __name__ == "__main__":
+    main()
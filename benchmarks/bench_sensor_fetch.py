@@ -0,0 +1,55 @@
+"""Benchmark of fetching many BlueTrack devices against a local stub server.
+
+Shows how the run time of the fetch stage in `sensor_data` scales with the number
+of devices, sequentially (max in flight 1) and with the concurrent fetch engine.
+
+    python benchmarks/bench_sensor_fetch.py --latency 0.05 --counts 1 8 32 128
+"""
+import argparse
+import time
+
+from stubs import load_lambda, stub_server
+
+
+def make_rows(device_id, count):
+    return [{
+        "gatewayId": 8,
+        "deviceId": device_id,
+        "timestamp": f"2022-10-01T12:{i % 60:02d}:00.000000",
+        "temperature": 20.5,
+        "humidity": 40.1,
+    } for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stub waits per request")
+    parser.add_argument("--rows", type=int, default=10, help="rows returned per device")
+    parser.add_argument("--counts", type=int, nargs="*", default=[1, 8, 32, 128])
+    parser.add_argument("--max-in-flight", type=int, default=16)
+    args = parser.parse_args()
+
+    def respond(path, headers):
+        time.sleep(args.latency)
+        device_id = int(path.split("/")[5])
+        return 200, {"Content-Type": "application/json"}, make_rows(device_id, args.rows)
+
+    with stub_server(respond) as url:
+        sensor_data = load_lambda("sensor_data", BLUETRACK_URL=url, MAX_IN_FLIGHT=str(args.max_in_flight),
+                                  REQUESTS_PER_SECOND="1000")
+        print(f"{'devices':>8} {'sequential s':>13} {'concurrent s':>13} {'speedup':>8}")
+        for count in args.counts:
+            sensors = [{"id": i} for i in range(count)]
+            timings = []
+            for max_in_flight in (1, args.max_in_flight):
+                start = time.perf_counter()
+                results = list(sensor_data.fetch_concurrently(
+                    lambda sensor: sensor_data.get_device_data(sensor["id"], "2022-10-01T12:00", "2022-10-01T13:00"),
+                    sensors, max_in_flight=max_in_flight, timeout=sensor_data.DEVICE_TIMEOUT))
+                timings.append(time.perf_counter() - start)
+                assert all(err is None for _, _, err in results)
+            print(f"{count:>8} {timings[0]:>13.3f} {timings[1]:>13.3f} {timings[0] / timings[1]:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""Benchmark of executing a timestream query over a long time range in parallel slices.
+
+Runs a `WHERE time > ago(Nd)` query against a fake query client, which sleeps for
+every page as the service would, once as a single query and once split in slices
+by `timestreamquery.executeSlicedQuery`, and checks that both give the same rows.
+
+    python benchmarks/bench_sliced_query.py --days 60 --slices 8 --page-latency 0.05
+"""
+import argparse
+import datetime
+import os
+import re
+import sys
+import time
+
+import pandas as pd
+
+from stubs import ROOT, FakeQueryClient
+
+sys.path.insert(0, os.path.join(ROOT, "yr_future_from_csv"))
+import timestreamquery  # noqa: E402
+
+COLUMN_INFO = [
+    {"Name": "time", "Type": {"ScalarType": "TIMESTAMP"}},
+    {"Name": "wind_direction_sin", "Type": {"ScalarType": "DOUBLE"}},
+]
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def fake_table(days, rows_per_page=1000):
+    """Rows every 10 minutes over the last days, returned for the time range of a query."""
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None, second=0, microsecond=0)
+    times = pd.date_range(now - datetime.timedelta(days=days), now, freq="10min")
+
+    def pages(query):
+        bounds = [EPOCH + datetime.timedelta(milliseconds=int(ms)) for ms in re.findall(r"from_milliseconds\((\d+)\)", query)]
+        if not bounds:
+            amount = int(re.search(r"ago\((\d+)d\)", query).group(1))
+            bounds = [datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None) - datetime.timedelta(days=amount)]
+        selected = times[times > bounds[0]]
+        if len(bounds) > 1:
+            selected = selected[selected <= bounds[1]]
+        rows = [{"Data": [{"ScalarValue": t.strftime("%Y-%m-%d %H:%M:%S.000000000")},
+                          {"ScalarValue": str(t.minute / 60)}]} for t in selected]
+        for start in range(0, max(1, len(rows)), rows_per_page):
+            yield {"QueryId": f"query-{len(bounds)}-{start}", "ColumnInfo": COLUMN_INFO,
+                   "Rows": rows[start: start + rows_per_page]}
+
+    return pages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--slices", type=int, default=8)
+    parser.add_argument("--page-latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    client = FakeQueryClient(fake_table(args.days), latency=args.page_latency)
+    query = f"SELECT time, wind_direction_sin FROM db.past WHERE time > ago({args.days}d)"
+    results = {}
+    print(f"{'execution':<10} {'seconds':>8} {'rows/s':>10}")
+    for name, slices in (("single", 1), ("sliced", args.slices)):
+        begin = time.perf_counter()
+        results[name] = timestreamquery.executeSlicedQuery(client, query, slices)
+        elapsed = time.perf_counter() - begin
+        print(f"{name:<10} {elapsed:>8.3f} {len(results[name]) / elapsed:>10.0f}")
+    # Both queries resolve ago() at slightly different times, compare the rows they have in common
+    common = results["single"].merge(results["sliced"], on="time", suffixes=("", "_sliced"))
+    assert len(common) >= len(results["single"]) - 1
+    assert (common["wind_direction_sin"] == common["wind_direction_sin_sliced"]).all()
+    assert results["sliced"]["time"].is_monotonic_increasing
+    assert results["sliced"]["time"].is_unique
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Benchmark of the per host rate limiter and circuit breaker against throttling and failing stub servers.
+
+Fetches many BlueTrack devices through `get_device_data` of `sensor_data`:
+
+- from a server allowing fewer requests per second than the lambda sends, answering
+  429 Too Many Requests, with or without a `Retry-After` header, above its limit.
+  Every device should be fetched, with the rate of the lambda lowered to the limit.
+- from a server answering 503 to every request, with and without the circuit breaker.
+  With the breaker only the requests sent before it opened reach the host, each with the
+  retries of the session, and the other devices fail at once with CircuitOpenError.
+
+    python benchmarks/bench_throttling.py --devices 60 --server-rate 10 --client-rate 40
+"""
+import argparse
+import json
+import threading
+import time
+
+from stubs import load_lambda, stub_server
+
+
+class ThrottlingServer:
+    """Answers BlueTrack requests at most `rate` times per second, and 429 above that."""
+
+    def __init__(self, rate, retry_after=None):
+        self.rate = rate
+        self.retry_after = retry_after
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.accepted = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, path, headers):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < 1:
+                self.throttled += 1
+                return 429, {"Retry-After": str(self.retry_after)} if self.retry_after else {}, b"Too Many Requests"
+            self.tokens -= 1
+            self.accepted += 1
+        device_id = int(path.split("/")[5])
+        return 200, {"Content-Type": "application/json"}, [
+            {"gatewayId": 8, "deviceId": device_id, "timestamp": "2022-10-01T12:00:00.000000", "temperature": 20.5}]
+
+
+class FailingServer:
+    """Answers 503 to every request."""
+
+    def __init__(self):
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, path, headers):
+        with self.lock:
+            self.calls += 1
+        return 503, {}, b"Service Unavailable"
+
+
+def fetch_devices(sensor_data, devices):
+    """Fetch every device concurrently, as the lambda does, returning the fetched and failed devices."""
+    from common.fetch import fetch_concurrently
+    fetched, errors = 0, {}
+    fetch = lambda device_id: sensor_data.get_device_data(device_id, "2022-10-01T12:00", "2022-10-01T12:10")
+    for _, _, err in fetch_concurrently(fetch, range(devices), max_in_flight=sensor_data.MAX_IN_FLIGHT):
+        if err is None:
+            fetched += 1
+        else:
+            errors[type(err).__name__] = errors.get(type(err).__name__, 0) + 1
+    return fetched, errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=60)
+    parser.add_argument("--server-rate", type=float, default=10, help="requests per second the throttling server accepts")
+    parser.add_argument("--client-rate", type=float, default=40, help="requests per second the lambda starts at")
+    args = parser.parse_args()
+
+    sensor_data = load_lambda("sensor_data", REQUESTS_PER_SECOND=str(args.client_rate), MAX_IN_FLIGHT="8",
+                              METRICS_FORMAT="off")
+    from common import http_client
+
+    print(f"{'throttling server':<24} {'seconds':>8} {'fetched':>8} {'429s':>6} {'rate':>6}")
+    for name, retry_after in (("with Retry-After", 1), ("without Retry-After", None)):
+        server = ThrottlingServer(args.server_rate, retry_after)
+        with stub_server(server) as url:
+            sensor_data.BLUETRACK_URL = url
+            start = time.perf_counter()
+            fetched, errors = fetch_devices(sensor_data, args.devices)
+            elapsed = time.perf_counter() - start
+            bucket, _ = http_client.get_limits(url)
+        print(f"{name:<24} {elapsed:>8.2f} {fetched:>8} {server.throttled:>6} {bucket.rate:>6.1f}")
+        assert fetched == args.devices, f"devices failed: {json.dumps(errors)}"
+        # Fewer devices than the burst of the server are not throttled
+        assert bucket.rate < args.client_rate or server.throttled == 0
+
+    print(f"\n{'failing server':<24} {'seconds':>8} {'calls':>8} {'errors'}")
+    threshold = http_client.FAILURE_THRESHOLD
+    calls, errors_by_name = {}, {}
+    for name, failure_threshold in (("without breaker", args.devices + 1), ("with breaker", threshold)):
+        # The breaker of a host is created with the threshold at its first request
+        http_client.FAILURE_THRESHOLD = failure_threshold
+        server = FailingServer()
+        with stub_server(server) as url:
+            sensor_data.BLUETRACK_URL = url
+            start = time.perf_counter()
+            fetched, errors = fetch_devices(sensor_data, args.devices)
+            elapsed = time.perf_counter() - start
+            retries = http_client.get_session(url).get_adapter(url).max_retries.total
+        calls[name], errors_by_name[name] = server.calls, errors
+        print(f"{name:<24} {elapsed:>8.2f} {server.calls:>8} {json.dumps(errors)}")
+        assert fetched == 0
+    http_client.FAILURE_THRESHOLD = threshold
+    # Up to MAX_IN_FLIGHT requests are already sent when the threshold is reached
+    sent = min(args.devices, threshold + sensor_data.MAX_IN_FLIGHT)
+    assert calls["with breaker"] <= sent * (retries + 1)
+    assert errors_by_name["with breaker"].get("CircuitOpenError", 0) >= args.devices - sent
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""Benchmark of converting BlueTrack timestamps to epoch milliseconds.
+
+Compares `datetime.strptime(...).timestamp()`, as used by sensor_data before, with
+`common.timestamps.iso_to_epoch_ms`, and checks that both give the same integers.
+Run with `TZ=UTC`, the timezone of the lambda hosts, for the check to be meaningful.
+
+    TZ=UTC python benchmarks/bench_timestamps.py --rows 200000
+"""
+import argparse
+import sys
+import time
+from datetime import datetime, timedelta
+
+from stubs import ROOT
+
+sys.path.insert(0, ROOT)
+from common.timestamps import iso_to_epoch_ms  # noqa: E402
+
+
+def strptime_to_epoch_ms(value):
+    return int(round(datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f').timestamp()*1000))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=200000)
+    args = parser.parse_args()
+
+    start = datetime(2022, 10, 1)
+    values = [(start + timedelta(seconds=i * 7, microseconds=i * 137)).strftime('%Y-%m-%dT%H:%M:%S.%f')
+              for i in range(args.rows)]
+
+    results = {}
+    print(f"{'parser':<16} {'seconds':>8} {'rows/s':>10}")
+    for name, convert in (("strptime", strptime_to_epoch_ms), ("iso_to_epoch_ms", iso_to_epoch_ms)):
+        begin = time.perf_counter()
+        results[name] = [convert(value) for value in values]
+        elapsed = time.perf_counter() - begin
+        print(f"{name:<16} {elapsed:>8.3f} {args.rows / elapsed:>10.0f}")
+    assert results["strptime"] == results["iso_to_epoch_ms"]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Benchmark of the TimestreamWriter against a fake timestream-write client.
+
+Compares writing batches one at a time with writing them concurrently, while the
+fake client throttles, fails and rejects records, and checks that every record is
+accounted for in the write summary.
+
+    python benchmarks/bench_timestream_writer.py --records 5000 --latency 0.02
+"""
+import argparse
+import sys
+import time
+
+from stubs import ROOT, FakeWriteClient
+
+sys.path.insert(0, ROOT)
+from common.timestream import TimestreamWriter  # noqa: E402
+
+
+def make_records(count):
+    return [{
+        "Dimensions": [{"Name": "gateway_id", "Value": "8"}, {"Name": "tagId", "Value": str(i % 10)}],
+        "Time": str(1664625600000 + i * 1000),
+        "MeasureName": "sensor_measurements",
+        "MeasureValueType": "MULTI",
+        "MeasureValues": [{"Name": "temperature", "Value": "20.5", "Type": "DOUBLE"}],
+    } for i in range(count)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--records", type=int, default=5000)
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--throttle-rate", type=float, default=0.1)
+    parser.add_argument("--error-rate", type=float, default=0.05)
+    parser.add_argument("--reject-rate", type=float, default=0.01)
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    for workers in (1, 4, 8):
+        client = FakeWriteClient(args.latency, args.throttle_rate, args.error_rate, args.reject_rate)
+        writer = TimestreamWriter(client, "db", "table", max_workers=workers, base_delay=0.01, max_delay=0.2)
+        start = time.perf_counter()
+        with writer:
+            writer.write(records)
+        elapsed = time.perf_counter() - start
+        summary = writer.summary
+        accounted = summary.written + summary.rejected + summary.failed
+        assert accounted == len(records), f"{accounted} of {len(records)} records accounted for"
+        assert summary.written == len(client.stored)
+        print(f"workers={workers:<2} {elapsed:6.2f}s {len(records) / elapsed:8.0f} records/s calls={client.calls} {summary}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Benchmark of the size of the WriteRecords requests sent by the TimestreamWriter.
+
+Builds the records of a multi-device window with the sensor_data extractor and of
+several gateways with the yr_past transform, batches them as the lambdas do, and
+serializes every request with the botocore serializer of `timestream-write`, with and
+without moving the shared attributes of a batch into CommonAttributes. Checks that
+timestream would store the same records both ways.
+
+    python benchmarks/bench_write_payload.py --devices 20 --minutes 60
+"""
+import argparse
+import sys
+import time
+
+import boto3
+
+from bench_frost_transform import make_payload as make_frost_payload
+from stubs import ROOT, expand_record, load_lambda
+
+sys.path.insert(0, ROOT)
+from common.pipeline import BATCH_SIZE  # noqa: E402
+from common.records import to_boto_records  # noqa: E402
+from common.timestream import compact_records  # noqa: E402
+
+
+def make_device_data(schema, device_id, minutes):
+    nested = "dataJson" in schema
+    names = list(schema["dataJson"] if nested else schema)
+    rows = []
+    for second in range(0, minutes * 60, 30):
+        values = {name: (second * 7 + i) % 1000 for i, name in enumerate(names)}
+        rows.append({
+            "gatewayId": 8,
+            "deviceId": device_id,
+            "timestamp": f"2022-10-01T{second // 3600:02d}:{second // 60 % 60:02d}:{second % 60:02d}.000000",
+            **({"dataJson": values} if nested else values),
+        })
+    return rows
+
+
+def sensor_records(devices, minutes):
+    sensor_data = load_lambda("sensor_data")
+    sensors = sensor_data.load_sensors()
+    records = []
+    for device in range(devices):
+        sensor, plan = sensors[device % len(sensors)]
+        device_data = make_device_data(sensor["data"], 1000 + device, minutes)
+        records += sensor_data.extract_device_records(device_data, plan)
+    return records
+
+
+def frost_records(gateways, days):
+    yr_past = load_lambda("yr_past")
+    rows = yr_past.frost_to_rows(make_frost_payload(1, days))
+    records = []
+    for gateway in range(gateways):
+        records += yr_past.extract_frost_records(rows, 63.44 + gateway / 100, 10.43, gateway)
+    return records
+
+
+def measure(records, compact):
+    client = boto3.client("timestream-write", region_name="eu-west-1",
+                          aws_access_key_id="key", aws_secret_access_key="secret")
+    operation = client.meta.service_model.operation_model("WriteRecords")
+    size = 0
+    compacting = serializing = 0.0
+    stored = []
+    for window_i in range(0, len(records), BATCH_SIZE):
+        batch = to_boto_records(records[window_i: window_i + BATCH_SIZE])
+        common_attributes = {"Version": 1667000000}
+        began = time.perf_counter()
+        if compact:
+            common_attributes, batch = compact_records(batch, common_attributes)
+        compacted = time.perf_counter()
+        request = client._serializer.serialize_to_request(
+            {"DatabaseName": "db", "TableName": "table", "Records": batch, "CommonAttributes": common_attributes}, operation)
+        compacting += compacted - began
+        serializing += time.perf_counter() - compacted
+        size += len(request["body"])
+        stored += [expand_record(record, common_attributes) for record in batch]
+    return size, compacting, serializing, stored
+
+
+def normalize(record):
+    return (record["Time"], record["MeasureName"], record["MeasureValueType"],
+            sorted((d["Name"], d["Value"]) for d in record["Dimensions"]),
+            [(m["Name"], m["Value"], m["Type"]) for m in record["MeasureValues"]])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--minutes", type=int, default=60)
+    parser.add_argument("--gateways", type=int, default=10)
+    parser.add_argument("--days", type=int, default=7)
+    args = parser.parse_args()
+
+    print(f"{'lambda':<12} {'records':>8} {'mode':<8} {'bytes':>10} {'bytes/rec':>10} {'compact s':>10} {'serialize s':>12}")
+    for name, records in (("sensor_data", sensor_records(args.devices, args.minutes)),
+                          ("yr_past", frost_records(args.gateways, args.days))):
+        results = {mode: measure(records, mode == "compact") for mode in ("full", "compact")}
+        assert [normalize(r) for r in results["full"][3]] == [normalize(r) for r in results["compact"][3]]
+        for mode, (size, compacting, serializing, _) in results.items():
+            print(f"{name:<12} {len(records):>8} {mode:<8} {size:>10} {size / len(records):>10.1f} "
+                  f"{compacting:>10.3f} {serializing:>12.3f}")
+        print(f"{name:<12} payload {1 - results['compact'][0] / results['full'][0]:.0%} smaller")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""Helpers shared by the benchmark scripts: local stub servers and lambda loading."""
+import importlib.util
+import json
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Values good enough for importing the lambdas without a real environment
+DEFAULT_ENV = {
+    "SECRET": "secret",
+    "ACCESS_KEY": "key",
+    "DATABASE_NAME": "db",
+    "TABLE_NAME": "table",
+    "COMPANY_ID": "1",
+    "TIME_DELTA": "10",
+    "CLIENT_ID": "client",
+    "AWS_DEFAULT_REGION": "eu-west-1",
+}
+
+
+def load_lambda(folder, **env):
+    """Import `<folder>/lambda_function.py` as `<folder>_lambda` and chdir into the folder,
+    as the lambdas read their json config relative to the working directory."""
+    for key, value in {**DEFAULT_ENV, **env}.items():
+        os.environ.setdefault(key, value)
+    path = os.path.join(ROOT, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+    os.chdir(path)
+    spec = importlib.util.spec_from_file_location(f"{folder}_lambda", os.path.join(path, "lambda_function.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def use_write_client(client):
+    """Make the lambdas write to `client` instead of a real timestream-write client."""
+    import common.sinks
+    common.sinks.get_write_client = lambda *args, **kwargs: client
+
+
+@contextmanager
+def stub_server(respond):
+    """Run a local HTTP server in a background thread and yield its base url.
+
+    :param respond: function called with the request path and headers, returning
+        `(status, headers, body)` where body is bytes or a json serializable object
+    """
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body are written separately, avoid the delayed ACK stall on keep-alive connections
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            status, headers, body = respond(self.path, self.headers)
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def expand_record(record, common_attributes):
+    """The record as timestream stores it, with the CommonAttributes of its request added."""
+    expanded = {**common_attributes, **record}
+    expanded["Dimensions"] = common_attributes.get("Dimensions", []) + record.get("Dimensions", [])
+    return expanded
+
+
+class FakeWriteClient:
+    """Stand-in for a boto3 `timestream-write` client.
+
+    Each call sleeps `latency` seconds and fails with throttling, a server error or
+    rejected records with the given probabilities. Stored records are kept in `stored`,
+    with the CommonAttributes of their request added, unless `keep` is False. The number
+    of stored records is counted in `written`.
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, error_rate=0.0, reject_rate=0.0, seed=0, keep=True):
+        import random
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.reject_rate = reject_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.keep = keep
+        self.calls = 0
+        self.written = 0
+        self.stored = []
+
+    def _error(self, code, status, **extra):
+        from botocore.exceptions import ClientError
+        response = {"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}, **extra}
+        return ClientError(response, "WriteRecords")
+
+    def write_records(self, DatabaseName, TableName, Records, CommonAttributes):
+        import time
+        time.sleep(self.latency)
+        with self.lock:
+            self.calls += 1
+            roll = self.random.random()
+            if roll < self.throttle_rate:
+                raise self._error("ThrottlingException", 400)
+            if roll < self.throttle_rate + self.error_rate:
+                raise self._error("InternalServerException", 500)
+            rejected = []
+            for index, record in enumerate(Records):
+                if self.random.random() < self.reject_rate:
+                    # Every other rejection is a version conflict, which is permanent
+                    reason = "Record version lower than existing" if index % 2 else "Transient ingestion failure"
+                    rejected.append({"RecordIndex": index, "Reason": reason})
+                else:
+                    self.written += 1
+                    if self.keep:
+                        self.stored.append(expand_record(record, CommonAttributes))
+            if rejected:
+                raise self._error("RejectedRecordsException", 419, RejectedRecords=rejected)
+        return {"ResponseMetadata": {"HTTPStatusCode": 200}, "RecordsIngested": {"Total": len(Records)}}
+
+
+class FakeQueryClient:
+    """Stand-in for a boto3 `timestream-query` client, returning the given pages.
+
+    :param pages: list of query result pages, or a function called with the query
+        string and returning them
+    :param latency: seconds slept before each page, as the time to fetch it
+    """
+
+    def __init__(self, pages, latency=0.0):
+        self.pages = pages
+        self.latency = latency
+        self.queries = []
+        self.cancelled = []
+
+    def get_paginator(self, operation):
+        return self
+
+    def paginate(self, QueryString):
+        import time
+        self.queries.append(QueryString)
+        pages = self.pages(QueryString) if callable(self.pages) else self.pages
+        for page in pages:
+            time.sleep(self.latency)
+            yield page
+
+    def cancel_query(self, QueryId):
+        self.cancelled.append(QueryId)
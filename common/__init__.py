@@ -0,0 +1,5 @@
+"""Code shared between the lambda functions.
+
+The folder is symlinked into every lambda folder, so it is importable when running
+a lambda as a script and is zipped into the deployment package by `package.sh`.
+"""
@@ -0,0 +1,50 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def fetch_concurrently(fetch, items, max_in_flight=8, timeout=None):
+    """Call `fetch(item)` for every item, running at most `max_in_flight` calls at once.
+
+    Yields `(item, result, error)` in completion order. A call that raises is yielded
+    with its exception and a call still running `timeout` seconds after it started is
+    yielded with a `TimeoutError`, so one slow or failing item never stalls the rest.
+
+    :param fetch: function called with a single item
+    :param items: items to fetch
+    :param max_in_flight: maximum number of concurrent calls
+    :param timeout: seconds each call may run before it is given up on, None to wait forever
+    """
+    started = {}
+
+    def run(key, item):
+        started[key] = time.monotonic()
+        return fetch(item)
+
+    executor = ThreadPoolExecutor(max_workers=max_in_flight)
+    try:
+        pending = {executor.submit(run, key, item): (key, item) for key, item in enumerate(items)}
+        while pending:
+            wait_for = None
+            if timeout is not None:
+                now = time.monotonic()
+                deadlines = [started[key] + timeout - now for key, _ in pending.values() if key in started]
+                wait_for = max(0, min(deadlines, default=timeout))
+            done, _ = wait(pending, timeout=wait_for, return_when=FIRST_COMPLETED)
+            for future in done:
+                _, item = pending.pop(future)
+                try:
+                    yield item, future.result(), None
+                except Exception as err:
+                    yield item, None, err
+            if timeout is not None:
+                now = time.monotonic()
+                for future, (key, item) in list(pending.items()):
+                    # A call which finished while the consumer was busy is yielded by the next wait
+                    if future.done():
+                        continue
+                    if key in started and now - started[key] >= timeout:
+                        del pending[future]
+                        yield item, None, TimeoutError(f"No response within {timeout} seconds")
+    finally:
+        # Do not wait for calls that timed out, their threads finish in the background
+        executor.shutdown(wait=False, cancel_futures=True)
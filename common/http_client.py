@@ -0,0 +1,132 @@
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from common.ratelimit import CircuitBreaker, TokenBucket
+
+# Seconds to wait for a connection and for data, unless another timeout is given
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 30
+# Maximum number of open connections to a single host
+MAX_CONNECTIONS = 10
+# Requests per second sent to a single host, lowered while the host answers 429 Too Many Requests
+REQUESTS_PER_SECOND = 20
+# Times a request answered with 429 is sent again, and the longest Retry-After waited for
+THROTTLE_RETRIES = 3
+MAX_RETRY_AFTER = 30
+# Seconds a request answered 429 without Retry-After waits before it is sent again, doubled for every retry
+THROTTLE_BACKOFF = 0.5
+# Failed requests in a row before a host is not called for COOLDOWN seconds
+FAILURE_THRESHOLD = 5
+COOLDOWN = 30
+
+# One session per host, kept at module scope so warm lambda invocations reuse the connections
+_sessions = {}
+_sessions_lock = threading.Lock()
+# Rate limiter and circuit breaker of each host, shared by all threads and kept at module scope like the sessions
+_limits = {}
+_limits_lock = threading.Lock()
+
+
+def get_session(url, max_connections=MAX_CONNECTIONS):
+    """Return the pooled session for the host of the url, creating it on first use.
+
+    The session keeps connections alive, asks for gzip compressed responses, retries
+    failed connections and 5xx responses with backoff, but not read timeouts, and opens at most
+    `max_connections` connections to the host, blocking when all are in use.
+    """
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        session = _sessions.get(host)
+        if session is None:
+            # 429 responses are left to `get`, which lowers the rate of the host instead of only waiting.
+            # Read timeouts are raised without a retry, so a hanging request gives up after its timeout
+            # instead of holding a pooled connection for several timeouts
+            retry = Retry(total=3, read=False, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504),
+                          allowed_methods=("GET",), raise_on_status=False, respect_retry_after_header=False)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_connections, pool_block=True, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers["Accept-Encoding"] = "gzip, deflate"
+            _sessions[host] = session
+        return session
+
+
+def get_limits(url, requests_per_second=REQUESTS_PER_SECOND):
+    """Return the rate limiter and circuit breaker of the host of the url, creating them on first use."""
+    host = urlsplit(url).netloc
+    with _limits_lock:
+        limits = _limits.get(host)
+        if limits is None:
+            limits = _limits[host] = (TokenBucket(requests_per_second),
+                                      CircuitBreaker(host, FAILURE_THRESHOLD, COOLDOWN))
+        return limits
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a `Retry-After` header, given in seconds or as a date, None when missing."""
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(MAX_RETRY_AFTER, max(0.0, seconds))
+
+
+def get(url, params=None, timeout=None, max_connections=MAX_CONNECTIONS,
+        requests_per_second=REQUESTS_PER_SECOND, **kwargs):
+    """Send a GET request through the pooled session, the rate limiter and the circuit breaker of the host.
+
+    A 429 response lowers the rate of the host, waits for its `Retry-After`, or backs off
+    without one, and sends the request again, at most THROTTLE_RETRIES times. Connection errors, timeouts and 5xx
+    responses, left after the retries of the session, count as failures of the host.
+    While the circuit breaker of the host is open `CircuitOpenError` is raised at once.
+    Other responses, also a 5xx, are returned, the caller checks their status.
+
+    :param timeout: seconds, or a (connect, read) tuple, default (CONNECT_TIMEOUT, READ_TIMEOUT)
+    :param max_connections: connection limit of the host, used when its session is created
+    :param requests_per_second: rate of the host, used when its rate limiter is created
+    :raises requests.HTTPError: when the host still answers 429 after the retries
+    """
+    if timeout is None:
+        timeout = (CONNECT_TIMEOUT, READ_TIMEOUT)
+    session = get_session(url, max_connections)
+    bucket, breaker = get_limits(url, requests_per_second)
+    for attempt in range(THROTTLE_RETRIES + 1):
+        # A throttled request is sent again even when other requests opened the breaker meanwhile
+        if attempt == 0:
+            breaker.before_call()
+        bucket.acquire()
+        try:
+            response = session.get(url, params=params, timeout=timeout, **kwargs)
+        except requests.RequestException:
+            breaker.record_failure()
+            raise
+        if response.status_code != 429:
+            if response.status_code >= 500:
+                breaker.record_failure()
+            else:
+                bucket.succeed()
+                breaker.record_success()
+            return response
+        retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        if bucket.throttle(retry_after):
+            print(f"{urlsplit(url).netloc} is throttling, lowered to {bucket.rate:.1f} requests per second"
+                  + (f" and waiting {retry_after:.1f} seconds" if retry_after else ""))
+        # The rate is lowered at most once per THROTTLE_WINDOW, and may still be above the limit of the host
+        if not retry_after and attempt < THROTTLE_RETRIES:
+            time.sleep(THROTTLE_BACKOFF * 2 ** attempt)
+    breaker.record_failure()
+    raise requests.HTTPError(f"429 Too Many Requests from {urlsplit(url).netloc} "
+                             f"after {THROTTLE_RETRIES} retries", response=response)
@@ -0,0 +1,200 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Format of the metrics line logged at the end of an invocation: json, emf (CloudWatch embedded metric format) or off
+METRICS_FORMAT = os.getenv("METRICS_FORMAT", "json")
+# Namespace of the CloudWatch metrics in the emf format
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "fetchAndStore")
+# Profile each invocation with cProfile: `stdout` prints the slowest functions, any other value is
+# a directory the profiles are written to. Only the thread calling the handler is profiled
+PROFILE = os.getenv("PROFILE")
+# Number of functions printed by the `stdout` profile
+PROFILE_LINES = 30
+
+STAGES = ("fetch", "parse", "transform", "write")
+
+# The invocation being measured, shared by all threads. None outside of `invocation`
+_current = None
+
+
+class Metrics:
+    """Timings and counts of one invocation of a lambda.
+
+    The time of each stage is summed per key, e.g. per device or station, and for the
+    whole invocation. Thread safe, the stages are timed from the fetch and write threads.
+
+    :param source: name of the lambda
+    :param breakdown: name of the keys in the metrics line, e.g. devices
+    """
+
+    def __init__(self, source, breakdown="devices"):
+        self.source = source
+        self.breakdown = breakdown
+        self.started = time.perf_counter()
+        self.stages = dict.fromkeys(STAGES, 0.0)
+        self.keys = {}
+        self.counts = {}
+        self.records = 0
+        self.summary = None
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, key=None, records=0):
+        """Add seconds spent in a stage, and records built, to the totals and to the key."""
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+            if key is not None:
+                key_metrics = self.keys.setdefault(str(key), {})
+                key_metrics[stage] = key_metrics.get(stage, 0.0) + seconds
+                if records:
+                    key_metrics["records"] = key_metrics.get("records", 0) + records
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def to_dict(self):
+        """The metrics line, with the times in milliseconds."""
+        elapsed = time.perf_counter() - self.started
+        line = {"source": self.source, "duration_ms": round(elapsed * 1000, 1), "records": self.records,
+                "records_per_second": round(self.records / elapsed, 1) if elapsed > 0 else 0.0}
+        line.update({f"{stage}_ms": round(seconds * 1000, 1) for stage, seconds in self.stages.items()})
+        line.update(self.counts)
+        if self.summary is not None:
+            latencies = sorted(self.summary.batch_latencies)
+            line.update(written=self.summary.written, rejected=self.summary.rejected,
+                        retried=self.summary.retried, failed=self.summary.failed, batches=len(latencies),
+                        batch_latency_p50_ms=round(percentile(latencies, 0.5) * 1000, 1),
+                        batch_latency_p99_ms=round(percentile(latencies, 0.99) * 1000, 1))
+        line[self.breakdown] = {key: {name: round(value * 1000, 1) if name in self.stages else value
+                                      for name, value in key_metrics.items()}
+                                for key, key_metrics in self.keys.items()}
+        return line
+
+    def to_emf(self):
+        """The metrics line in the CloudWatch embedded metric format, with the lambda as dimension.
+
+        The numbers of the line are metrics, the breakdown is only kept in the log.
+        """
+        line = self.to_dict()
+        units = {"records_per_second": "Count/Second"}
+        names = [name for name, value in line.items()
+                 if isinstance(value, (int, float)) and not isinstance(value, bool)]
+        line["_aws"] = {
+            "Timestamp": int(time.time() * 1000),
+            "CloudWatchMetrics": [{
+                "Namespace": METRICS_NAMESPACE,
+                "Dimensions": [["source"]],
+                "Metrics": [{"Name": name, "Unit": units.get(name, "Milliseconds" if name.endswith("_ms") else "Count")}
+                            for name in names],
+            }],
+        }
+        return line
+
+    def emit(self, metrics_format=METRICS_FORMAT):
+        if metrics_format == "off":
+            return
+        print(json.dumps(self.to_emf() if metrics_format == "emf" else self.to_dict()))
+
+
+def percentile(values, fraction):
+    """The value at a fraction of the sorted values, 0 without values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def add(stage, seconds, key=None):
+    """Add seconds spent in a stage to the current invocation, for a key when given."""
+    if _current is not None:
+        _current.add(stage, seconds, key)
+
+
+@contextmanager
+def timer(stage, key=None):
+    """Time a stage of the current invocation, for a key when given."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(stage, time.perf_counter() - start, key)
+
+
+def timed(stage, key, records):
+    """Iterate records, timing the stage while each record is built and counting the records of the key.
+
+    The time the consumer spends between the records is not part of the stage.
+    """
+    iterator = iter(records)
+    seconds = 0.0
+    count = 0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                record = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                seconds += time.perf_counter() - start
+            count += 1
+            yield record
+    finally:
+        if _current is not None:
+            _current.add(stage, seconds, key, records=count)
+
+
+def count(name, value=1):
+    """Add to a count of the current invocation, e.g. fetch_errors."""
+    if _current is not None:
+        _current.count(name, value)
+
+
+def record_summary(summary, records):
+    """Set the summary of the writer and the number of records built in the current invocation."""
+    if _current is not None:
+        _current.summary = summary
+        _current.records = records
+
+
+@contextmanager
+def profile(source, setting=PROFILE):
+    """Profile the calling thread with cProfile when PROFILE is set."""
+    if not setting:
+        yield
+        return
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if setting == "stdout":
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(PROFILE_LINES)
+        else:
+            os.makedirs(setting, exist_ok=True)
+            profiler.dump_stats(os.path.join(setting, f"{source}-{int(time.time() * 1000)}.prof"))
+
+
+@contextmanager
+def invocation(source, breakdown="devices"):
+    """Measure an invocation, logging the metrics line when it ends, also when it fails.
+
+    The stages are timed with `timer` and `timed` from any thread while the invocation runs.
+    """
+    global _current
+    metrics = _current = Metrics(source, breakdown)
+    try:
+        with profile(source):
+            yield metrics
+    except BaseException as err:
+        metrics.counts["error"] = type(err).__name__
+        raise
+    finally:
+        _current = None
+        metrics.emit()
@@ -0,0 +1,82 @@
+import queue
+import threading
+
+# Maximum number of records in a single Timestream WriteRecords call
+BATCH_SIZE = 100
+
+_DONE = object()
+
+
+class BatchPipeline:
+    """Writer stage of a producer/consumer pipeline.
+
+    Records are put into the pipeline as they are extracted and collected into
+    batches of `batch_size`. Full batches are handed to `write_batch` by a
+    background thread, so writing overlaps with fetching and parsing. At most
+    `max_pending` batches are buffered, a producer putting records while the buffer
+    is full blocks until the writer catches up, keeping the memory usage bounded.
+
+    Use it as a context manager, leaving the block flushes the last partial batch
+    and waits for all batches to be written.
+    """
+
+    def __init__(self, write_batch, batch_size=BATCH_SIZE, max_pending=10):
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        # Number of records put into the pipeline
+        self.count = 0
+        self._batch = []
+        self._lock = threading.Lock()
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            if batch is _DONE:
+                return
+            # Keep draining after an error so producers never block on a full queue
+            if self._error is None:
+                try:
+                    self.write_batch(batch)
+                except Exception as err:
+                    self._error = err
+
+    def put(self, record):
+        """Add a single record to the pipeline."""
+        with self._lock:
+            self._batch.append(record)
+            self.count += 1
+            if len(self._batch) < self.batch_size:
+                return
+            batch, self._batch = self._batch, []
+        self._queue.put(batch)
+
+    def extend(self, records):
+        """Add all records from an iterable, consuming it lazily."""
+        for record in records:
+            self.put(record)
+
+    def close(self):
+        """Write the last partial batch and wait for the writer to finish."""
+        with self._lock:
+            batch, self._batch = self._batch, []
+        if batch:
+            self._queue.put(batch)
+        self._queue.put(_DONE)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.close()
+        except Exception:
+            # Do not hide the exception raised inside the block
+            if exc_type is None:
+                raise
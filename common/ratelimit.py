@@ -0,0 +1,134 @@
+import threading
+import time
+
+# Part of the configured rate added back per second without throttling, once the rate was lowered
+RECOVERY = 0.05
+# Seconds after lowering the rate where more throttled calls, sent before it was lowered, do not lower it again
+THROTTLE_WINDOW = 1.0
+
+
+class TokenBucket:
+    """Thread safe token bucket allowing `rate` calls per second, with bursts of `capacity` calls.
+
+    The rate adapts to the server: `throttle` halves it and can pause all calls, after a
+    429 response, and `succeed` raises it again by RECOVERY of the configured rate per second,
+    so the rate settles just below the limit of the server.
+
+    :param min_rate: lowest rate `throttle` goes down to, default a sixteenth of the rate
+    """
+
+    def __init__(self, rate, capacity=None, min_rate=None):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min_rate if min_rate is not None else rate / 16
+        self.capacity = capacity if capacity is not None else max(1, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._raised = self._updated
+        self._lowered = None
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Take a token, sleeping until one is available."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self, retry_after=None):
+        """Halve the rate after the server throttled a call, dropping the saved up burst.
+
+        The calls in flight when the server starts throttling are throttled together,
+        those lower the rate once.
+
+        :param retry_after: seconds no calls are made, from the `Retry-After` header, or None
+        :return: True when the rate was lowered
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            lowered = self._lowered is None or now - self._lowered >= THROTTLE_WINDOW
+            if lowered:
+                self.rate = max(self.min_rate, self.rate / 2)
+                self._lowered = now
+            self._tokens = min(self._tokens, 0)
+            self._raised = now
+            if retry_after:
+                self._paused_until = max(self._paused_until, now + retry_after)
+            return lowered
+
+    def succeed(self):
+        """Raise a lowered rate after a call the server accepted, by the time since it was last raised."""
+        if self.rate >= self.max_rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY * (now - self._raised))
+            self._raised = now
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a host while its circuit breaker is open."""
+
+
+class CircuitBreaker:
+    """Thread safe circuit breaker, which stops calling a failing host for a while.
+
+    After `failure_threshold` failed calls in a row the breaker opens, and `before_call`
+    raises `CircuitOpenError` for `cooldown` seconds. Then a single trial call is let
+    through, which closes the breaker when it succeeds and opens it again when it fails.
+    """
+
+    def __init__(self, name, failure_threshold=5, cooldown=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def before_call(self):
+        """Check that the host may be called, raising `CircuitOpenError` when it may not."""
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.cooldown - time.monotonic()
+            if remaining > 0 or self._trial:
+                raise CircuitOpenError(f"{self.name} failed {self.failures} times in a row, "
+                                       f"not called for {max(0, remaining):.0f} more seconds")
+            self._trial = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial:
+                    print(f"Circuit breaker of {self.name} opened for {self.cooldown:.0f} seconds "
+                          f"after {self.failures} failures")
+                self._opened_at = time.monotonic()
+                self._trial = False
@@ -0,0 +1,42 @@
+class Record:
+    """A timestream MULTI record, kept compact until it is sent.
+
+    A record built as boto3 dicts holds a dict per measure and per dimension. Here
+    the dimensions and the names and types of the measures are shared by all the
+    records of a device, and only the time and the values are stored per record.
+    The values are kept as parsed and turned into strings by `to_boto`, when the
+    record is written.
+
+    :param dimensions: boto3 dimension dicts, shared by the records of a device
+    :param time: time in epoch ms
+    :param measure_name: name of the multi measure
+    :param measures: tuple of `(name, type)` of the values, shared by records with the same measures
+    :param values: values of the measures
+    """
+    __slots__ = ("dimensions", "time", "measure_name", "measures", "values")
+
+    def __init__(self, dimensions, time, measure_name, measures, values):
+        self.dimensions = dimensions
+        self.time = time
+        self.measure_name = measure_name
+        self.measures = measures
+        self.values = values
+
+    def to_boto(self):
+        """The record in the shape of the `Records` of a boto3 `write_records` call."""
+        return {
+            'Dimensions': self.dimensions,
+            'Time': str(self.time),
+            'MeasureName': self.measure_name,
+            'MeasureValueType': 'MULTI',
+            'MeasureValues': [{'Name': name, 'Value': str(value), 'Type': measure_type}
+                              for (name, measure_type), value in zip(self.measures, self.values)],
+        }
+
+    def __repr__(self):
+        return f"Record({self.to_boto()!r})"
+
+
+def to_boto_records(records):
+    """Convert records to the boto3 shape, records already in that shape are kept as they are."""
+    return [record.to_boto() if isinstance(record, Record) else record for record in records]
@@ -0,0 +1,36 @@
+"""Replay records stored by the parquet sink into a timestream table, without calling the APIs again.
+
+Run from the folder of a lambda function, e.g.
+`python -m common.replay /tmp/capture/source=sensor_data --database <database> --table <table>`
+"""
+import argparse
+import os
+import time
+from datetime import datetime
+
+from common.sinks import replay
+from common.timestream import TimestreamWriter, get_write_client
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("path", help="parquet file or directory written by the parquet sink")
+    parser.add_argument("--database", default=os.getenv("DATABASE_NAME"))
+    parser.add_argument("--table", default=os.getenv("TABLE_NAME"))
+    parser.add_argument("--version", action="store_true",
+                        help="set the record version to the current time, to overwrite existing values")
+    args = parser.parse_args()
+    if not args.database or not args.table:
+        parser.error("--database and --table, or DATABASE_NAME and TABLE_NAME, are required")
+
+    common_attributes = (lambda: {'Version': round(datetime.now().timestamp())}) if args.version else None
+    start = time.perf_counter()
+    with TimestreamWriter(get_write_client(), args.database, args.table, common_attributes=common_attributes) as writer:
+        count = replay(args.path, writer)
+    elapsed = time.perf_counter() - start
+    print(f"Replayed {count} records in {elapsed:.1f}s ({count / elapsed:.0f} records/s)")
+    print("WriteRecords Summary:", writer.summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import os
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from common import metrics
+from common.pipeline import BATCH_SIZE
+from common.records import Record, to_boto_records
+from common.timestream import TimestreamWriter, WriteSummary, get_write_client
+
+# Converts the string values of timestream records to the python value stored in parquet
+PARQUET_CONVERTERS = {
+    "DOUBLE": float,
+    "BIGINT": int,
+    "VARCHAR": str,
+    "BOOLEAN": lambda value: value.lower() == "true",
+}
+
+
+def _arrow_types():
+    import pyarrow as pa
+    return {"DOUBLE": pa.float64(), "BIGINT": pa.int64(), "VARCHAR": pa.string(), "BOOLEAN": pa.bool_()}
+
+
+class ParquetSink:
+    """Stores records in parquet files instead of writing them to timestream.
+
+    The files are partitioned as `<root>/source=<source>/day=<YYYY-MM-DD>/device=<device>/`,
+    where the device is the value of the `device_dimension` dimension of a record. Each
+    dimension and measure is a column, with its role and timestream type kept in the field
+    metadata, so `replay` can turn the rows back into the same records.
+
+    Has the same interface as `TimestreamWriter`: `submit`, `write_batch`, `close` and `summary`.
+
+    :param rows_per_file: rows buffered for a partition before they are written to a file
+    """
+
+    def __init__(self, root, source, device_dimension, rows_per_file=100000):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError("The parquet sink needs pyarrow, install it with `pip install pyarrow`")
+        self.root = root
+        self.source = source
+        self.device_dimension = device_dimension
+        self.rows_per_file = rows_per_file
+        self.summary = WriteSummary()
+        self._partitions = {}
+        self._lock = threading.Lock()
+
+    def _partition(self, record):
+        if isinstance(record, Record):
+            time, dimensions = record.time, record.dimensions
+        else:
+            time, dimensions = record["Time"], record["Dimensions"]
+        day = datetime.fromtimestamp(int(time) / 1000, timezone.utc).strftime("%Y-%m-%d")
+        device = next((d["Value"] for d in dimensions if d["Name"] == self.device_dimension), "unknown")
+        return day, device
+
+    def write_batch(self, records):
+        """Buffer records in their partitions, writing the partitions which are full.
+
+        :return: number of records which failed to be written, always 0
+        """
+        full = []
+        with self._lock:
+            for record in records:
+                partition = self._partition(record)
+                rows = self._partitions.setdefault(partition, [])
+                rows.append(record)
+                if len(rows) >= self.rows_per_file:
+                    full.append((partition, self._partitions.pop(partition)))
+            self.summary.written += len(records)
+        for partition, rows in full:
+            self._write_file(partition, rows)
+        return 0
+
+    submit = write_batch
+
+    def _write_file(self, partition, records):
+        with metrics.timer("write"):
+            self._write_table(partition, records)
+
+    def _write_table(self, partition, records):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        arrow_types = _arrow_types()
+        columns = {"time": ([], pa.int64(), {"role": "time"}),
+                   "measure_name": ([], pa.string(), {"role": "measure_name"})}
+        for row, record in enumerate(to_boto_records(records)):
+            values = {"time": int(record["Time"]), "measure_name": record["MeasureName"]}
+            for dimension in record["Dimensions"]:
+                name = f"dimension.{dimension['Name']}"
+                if name not in columns:
+                    columns[name] = ([None] * row, pa.string(), {"role": "dimension", "name": dimension["Name"]})
+                values[name] = dimension["Value"]
+            for measure in record.get("MeasureValues", []):
+                name = f"measure.{measure['Name']}"
+                if name not in columns:
+                    columns[name] = ([None] * row, arrow_types[measure["Type"]],
+                                     {"role": "measure", "name": measure["Name"], "type": measure["Type"]})
+                values[name] = PARQUET_CONVERTERS[measure["Type"]](measure["Value"])
+            for name, (column, _, _) in columns.items():
+                column.append(values.get(name))
+
+        fields = [pa.field(name, arrow_type, metadata=metadata) for name, (_, arrow_type, metadata) in columns.items()]
+        table = pa.Table.from_arrays([pa.array(column, type=arrow_type) for column, arrow_type, _ in columns.values()],
+                                     schema=pa.schema(fields))
+        day, device = partition
+        directory = os.path.join(self.root, f"source={self.source}", f"day={day}", f"device={device}")
+        os.makedirs(directory, exist_ok=True)
+        pq.write_table(table, os.path.join(directory, f"part-{uuid.uuid4().hex}.parquet"))
+
+    def close(self):
+        """Write all buffered partitions and return the summary."""
+        with self._lock:
+            partitions, self._partitions = self._partitions, {}
+        for partition, rows in partitions.items():
+            self._write_file(partition, rows)
+        return self.summary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_sink(spec, database, table, source, device_dimension, common_attributes=None):
+    """Open the sink described by `spec`, `timestream` or `parquet:<directory>`.
+
+    :param database: timestream database, used by the timestream sink
+    :param table: timestream table, used by the timestream sink
+    :param source: name of the scraper, used to partition the parquet files
+    :param device_dimension: dimension used to partition the parquet files
+    :param common_attributes: CommonAttributes of the timestream sink, or a function returning them
+    """
+    kind, _, location = (spec or "timestream").partition(":")
+    if kind == "timestream":
+        return TimestreamWriter(get_write_client(), database, table, common_attributes=common_attributes)
+    if kind == "parquet":
+        return ParquetSink(location, source, device_dimension)
+    raise ValueError(f"Unknown sink '{kind}', expected timestream or parquet:<directory>")
+
+
+def read_parquet_records(path, batch_size=BATCH_SIZE):
+    """Read the records stored by a `ParquetSink`, yielding lists of at most batch_size records.
+
+    :param path: a parquet file, or a directory searched for parquet files
+    """
+    import pyarrow.parquet as pq
+
+    if os.path.isdir(path):
+        files = sorted(os.path.join(directory, name) for directory, _, names in os.walk(path)
+                       for name in names if name.endswith(".parquet"))
+    else:
+        files = [path]
+    for file_path in files:
+        parquet_file = pq.ParquetFile(file_path)
+        fields = [(field.name, {key.decode(): value.decode() for key, value in (field.metadata or {}).items()})
+                  for field in parquet_file.schema_arrow]
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            columns = [(metadata, batch.column(name).to_pylist()) for name, metadata in fields]
+            records = []
+            for row in range(batch.num_rows):
+                record = {"Dimensions": [], "MeasureValueType": "MULTI", "MeasureValues": []}
+                for metadata, values in columns:
+                    value = values[row]
+                    role = metadata.get("role")
+                    if role == "time":
+                        record["Time"] = str(value)
+                    elif role == "measure_name":
+                        record["MeasureName"] = value
+                    elif value is None:
+                        continue
+                    elif role == "dimension":
+                        record["Dimensions"].append({"Name": metadata["name"], "Value": value})
+                    elif role == "measure":
+                        if metadata["type"] == "BOOLEAN":
+                            value = "true" if value else "false"
+                        record["MeasureValues"].append({"Name": metadata["name"], "Value": str(value), "Type": metadata["type"]})
+                records.append(record)
+            yield records
+
+
+def replay(path, sink):
+    """Stream the records stored by a `ParquetSink` into another sink, e.g. a `TimestreamWriter`."""
+    count = 0
+    for records in read_parquet_records(path):
+        sink.submit(records)
+        count += len(records)
+    return count
@@ -0,0 +1,71 @@
+import json
+import os
+import sqlite3
+import threading
+
+
+class FileStateStore:
+    """Key/value state kept in a json file, e.g. in /tmp to survive warm lambda invocations."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        try:
+            with open(path) as state_file:
+                self._state = json.load(state_file)
+        except FileNotFoundError:
+            self._state = {}
+
+    def get(self, key, default=None):
+        return self._state.get(key, default)
+
+    def update(self, values):
+        """Set several keys at once and write the file."""
+        with self._lock:
+            self._state.update(values)
+            # Write to a temporary file first, so a crash never leaves a half written file
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as state_file:
+                json.dump(self._state, state_file)
+            os.replace(tmp_path, self.path)
+
+
+class SqliteStateStore:
+    """Key/value state kept in a SQLite database."""
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+
+    def get(self, key, default=None):
+        with self._lock:
+            row = self._connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def update(self, values):
+        """Set several keys at once in a single transaction."""
+        with self._lock, self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)",
+                                         [(key, json.dumps(value)) for key, value in values.items()])
+
+
+STATE_STORES = {
+    "file": FileStateStore,
+    "sqlite": SqliteStateStore,
+}
+
+
+def open_state_store(url):
+    """Open the state store described by `<kind>:<location>`, e.g. `file:/tmp/state.json`
+    or `sqlite:/tmp/state.db`. New kinds, such as DynamoDB, are added to `STATE_STORES`.
+
+    :return: the state store, or None when url is empty
+    """
+    if not url:
+        return None
+    kind, _, location = url.partition(":")
+    if kind not in STATE_STORES:
+        raise ValueError(f"Unknown state store '{kind}', expected one of {', '.join(STATE_STORES)}")
+    return STATE_STORES[kind](location)
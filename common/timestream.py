@@ -0,0 +1,250 @@
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from common import metrics
+from common.pipeline import BATCH_SIZE
+from common.records import Record, to_boto_records
+
+# Error codes where the whole batch can be sent again
+RETRYABLE_ERROR_CODES = ("ThrottlingException", "InternalServerException", "ServiceUnavailableException",
+                         "RequestTimeout", "RequestTimeoutException")
+# Rejections which will fail the same way if the record is sent again, e.g. a version conflict
+PERMANENT_REJECTION_REASONS = ("version", "retention", "duplicate", "invalid", "exceed", "mismatch", "schema")
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_write_client(max_pool_connections=10):
+    """Return a `timestream-write` client, created once and reused by all writers.
+
+    The client retries nothing itself, retries are done by the `TimestreamWriter`.
+    boto3 is imported here rather than at module scope, as importing it is a large part
+    of the cold start of a lambda and the parquet sink never needs it.
+    """
+    with _clients_lock:
+        if max_pool_connections not in _clients:
+            import boto3
+            from botocore.config import Config
+
+            config = Config(max_pool_connections=max_pool_connections, retries={"total_max_attempts": 1, "mode": "standard"})
+            _clients[max_pool_connections] = boto3.client("timestream-write", config=config)
+        return _clients[max_pool_connections]
+
+
+def is_retryable_rejection(rejected_record):
+    """Check if a record in `RejectedRecords` may be accepted when it is sent again."""
+    if "ExistingVersion" in rejected_record:
+        return False
+    reason = rejected_record.get("Reason", "").lower()
+    return not any(permanent in reason for permanent in PERMANENT_REJECTION_REASONS)
+
+
+def compact_records(records, common_attributes):
+    """Move the attributes shared by all records of a batch into its CommonAttributes.
+
+    The measure name and value type, and the dimensions with the same value in every
+    record, are sent once in CommonAttributes, timestream adds them to each record.
+    Only the remaining dimensions are left in the records, shrinking the request.
+
+    :return: the CommonAttributes and the records to send
+    """
+    if not records:
+        return common_attributes, records
+    common = dict(common_attributes)
+    first = records[0]
+    moved = set()
+    for key in ("MeasureName", "MeasureValueType", "TimeUnit"):
+        if key in first and key not in common and all(record.get(key) == first[key] for record in records):
+            common[key] = first[key]
+            moved.add(key)
+
+    shared = []
+    if "Dimensions" not in common:
+        dimensions = first.get("Dimensions", [])
+        # Records of the same device usually share the same list of dimensions
+        shared = [dimension for dimension in dimensions
+                  if all(record.get("Dimensions") is dimensions or dimension in record.get("Dimensions", ())
+                         for record in records)]
+        if shared:
+            common["Dimensions"] = shared
+            moved.add("Dimensions")
+    if not moved:
+        return common_attributes, records
+
+    compacted = []
+    for record in records:
+        compact = {key: value for key, value in record.items() if key not in moved}
+        if shared:
+            remaining = [dimension for dimension in record["Dimensions"] if dimension not in shared]
+            if remaining:
+                compact["Dimensions"] = remaining
+        compacted.append(compact)
+    return common, compacted
+
+
+def group_key(record):
+    """Key ordering records by their dimensions and measure name, so batches share more attributes."""
+    if isinstance(record, Record):
+        dimensions, measure_name = record.dimensions, record.measure_name
+    else:
+        dimensions, measure_name = record.get("Dimensions", ()), record.get("MeasureName", "")
+    return tuple((dimension["Name"], dimension["Value"]) for dimension in dimensions), measure_name
+
+
+@dataclass
+class WriteSummary:
+    """Outcome of all batches written by a `TimestreamWriter`."""
+    # Records accepted by timestream
+    written: int = 0
+    # Records rejected by timestream, and not accepted by a retry
+    rejected: int = 0
+    # Number of times a record was sent again
+    retried: int = 0
+    # Records given up on after an error or when out of attempts
+    failed: int = 0
+    # Seconds used by each write_records call
+    batch_latencies: list = field(default_factory=list)
+
+    def __str__(self):
+        latencies = sorted(self.batch_latencies)
+        median = latencies[len(latencies) // 2] if latencies else 0
+        return (f"written={self.written} rejected={self.rejected} retried={self.retried} failed={self.failed} "
+                f"batches={len(latencies)} median_latency={median:.3f}s")
+
+
+class TimestreamWriter:
+    """Writes batches of records to a timestream table, several batches at a time.
+
+    Throttled batches and server errors are retried with jittered exponential backoff.
+    When timestream rejects records, only the rejected records which may succeed
+    on a new attempt are sent again. The outcome is collected in `summary`.
+
+    :param client: `timestream-write` client, see `get_write_client`
+    :param database: name of the timestream database
+    :param table: name of the timestream table
+    :param common_attributes: CommonAttributes for each batch, or a function returning them
+    :param max_workers: number of batches written concurrently
+    :param max_attempts: number of times a record is sent before giving up
+    :param compact: send the attributes shared by the records of a batch once, see `compact_records`
+    """
+
+    def __init__(self, client, database, table, common_attributes=None, max_workers=4, max_attempts=5,
+                 base_delay=0.1, max_delay=5.0, compact=True):
+        self.client = client
+        self.compact = compact
+        self.database = database
+        self.table = table
+        self.common_attributes = common_attributes if common_attributes is not None else {}
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.summary = WriteSummary()
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Bounds the number of batches waiting on the executor
+        self._slots = threading.BoundedSemaphore(max_workers * 2)
+        self._futures = []
+
+    def _update(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self.summary, name, getattr(self.summary, name) + value)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def write_batch(self, records):
+        """Write at most 100 records, retrying until done or out of attempts.
+
+        :return: number of records which failed to be written, rejected records excluded
+        """
+        records = to_boto_records(records)
+        for attempt in range(1, self.max_attempts + 1):
+            common_attributes = self.common_attributes() if callable(self.common_attributes) else self.common_attributes
+            sent = records
+            if self.compact:
+                common_attributes, sent = compact_records(records, common_attributes)
+            start = time.perf_counter()
+            try:
+                self.client.write_records(DatabaseName=self.database, TableName=self.table,
+                                          Records=sent, CommonAttributes=common_attributes)
+                self._record_latency(start)
+                self._update(written=len(records))
+                return 0
+            except ClientError as err:
+                self._record_latency(start)
+                code = err.response.get("Error", {}).get("Code")
+                status = err.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+                if code == "RejectedRecordsException":
+                    # Records not in RejectedRecords are stored by timestream
+                    rejected = err.response.get("RejectedRecords", [])
+                    retryable = [r for r in rejected if is_retryable_rejection(r)]
+                    for r in rejected:
+                        if r not in retryable:
+                            print("Rejected record:", r.get("Reason"))
+                    self._update(written=len(records) - len(rejected), rejected=len(rejected) - len(retryable))
+                    records = [records[r["RecordIndex"]] for r in retryable]
+                    if not records:
+                        return 0
+                elif code not in RETRYABLE_ERROR_CODES and status < 500:
+                    print("Error:", err)
+                    self._update(failed=len(records))
+                    return len(records)
+            except BotoCoreError as err:
+                # Connection errors and timeouts
+                self._record_latency(start)
+                print("Error:", err)
+            if attempt < self.max_attempts:
+                self._update(retried=len(records))
+                time.sleep(self._backoff(attempt))
+        print(f"Giving up on {len(records)} records after {self.max_attempts} attempts")
+        self._update(failed=len(records))
+        return len(records)
+
+    def _record_latency(self, start):
+        latency = time.perf_counter() - start
+        with self._lock:
+            self.summary.batch_latencies.append(latency)
+        metrics.add("write", latency)
+
+    def _write_batch_and_release(self, records):
+        try:
+            self.write_batch(records)
+        finally:
+            self._slots.release()
+
+    def submit(self, records):
+        """Write a batch in the background, blocks while too many batches are pending."""
+        self._slots.acquire()
+        self._futures.append(self._executor.submit(self._write_batch_and_release, records))
+
+    def write(self, records):
+        """Split records into batches of 100 and submit them.
+
+        The records are ordered by their dimensions and measure name first, so the
+        records of a batch share as many attributes as possible.
+        """
+        records = sorted(records, key=group_key) if self.compact else list(records)
+        for window_i in range(0, len(records), BATCH_SIZE):
+            self.submit(records[window_i: window_i + BATCH_SIZE])
+
+    def close(self):
+        """Wait for all submitted batches and return the summary."""
+        self._executor.shutdown(wait=True)
+        for future in self._futures:
+            # Surface unexpected errors from the write threads
+            future.result()
+        self._futures = []
+        return self.summary
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,184 @@
+'''
+Parallel and resumable backfill of sensor data, used by the cli of lambda_function.py.
+
+The time range of every device is split into lanes, which are fetched in chunks by a pool
+of threads. The size of the next chunk of a device adapts to the number of points the device
+returned, so every request fetches roughly the same amount of data. Finished chunks are
+stored in a checkpoint file, and an interrupted backfill continues where it stopped when
+run again with the same checkpoint.
+'''
+import argparse
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta, timezone
+
+import lambda_function as sensor_data
+from common.pipeline import BATCH_SIZE
+from common.state import FileStateStore
+
+TIME_FORMAT = "%Y-%m-%dT%H:%M"
+MIN_CHUNK = timedelta(hours=1)
+MAX_CHUNK = timedelta(days=7)
+
+
+def parse_time(value):
+    return datetime.strptime(value, TIME_FORMAT).replace(tzinfo=timezone.utc)
+
+
+def format_time(value):
+    return value.strftime(TIME_FORMAT)
+
+
+def done_intervals(checkpoint, device_id):
+    '''
+    Get the merged intervals of a device already stored in the checkpoint.
+    '''
+    return [(parse_time(start), parse_time(end)) for start, end in checkpoint.get(str(device_id), [])]
+
+
+def mark_done(checkpoint, device_id, start, end):
+    '''
+    Add an interval to the done intervals of a device, merging overlapping intervals.
+    '''
+    intervals = sorted(done_intervals(checkpoint, device_id) + [(start, end)])
+    merged = [intervals[0]]
+    for interval_start, interval_end in intervals[1:]:
+        if interval_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], interval_end))
+        else:
+            merged.append((interval_start, interval_end))
+    checkpoint.update({str(device_id): [[format_time(s), format_time(e)] for s, e in merged]})
+
+
+def remaining_intervals(done, start, end):
+    '''
+    Get the parts of [start, end] not covered by the done intervals.
+    '''
+    gaps = []
+    cursor = start
+    for done_start, done_end in done:
+        if done_start > cursor:
+            gaps.append((cursor, min(done_start, end)))
+        cursor = max(cursor, done_end)
+        if cursor >= end:
+            break
+    if cursor < end:
+        gaps.append((cursor, end))
+    return [(gap_start, gap_end) for gap_start, gap_end in gaps if gap_start < gap_end]
+
+
+def next_chunk_size(duration, points, target_points):
+    '''
+    Size the next chunk of a device to return about target_points points.
+    '''
+    if points == 0:
+        size = duration * 2
+    else:
+        size = duration * (target_points / points)
+    size = min(MAX_CHUNK, max(MIN_CHUNK, size))
+    # The api only takes whole minutes
+    return timedelta(minutes=int(size.total_seconds() // 60))
+
+
+def split_lanes(sensors, checkpoint, start, end, workers, initial_chunk):
+    '''
+    Split the remaining time of every device into lanes, enough to keep all workers busy.
+    '''
+    lanes_per_device = max(1, math.ceil(workers / max(1, len(sensors))))
+    lanes = []
+    for sensor, plan in sensors:
+        for gap_start, gap_end in remaining_intervals(done_intervals(checkpoint, sensor["id"]), start, end):
+            count = max(1, min(lanes_per_device, int((gap_end - gap_start) / initial_chunk)))
+            step = (gap_end - gap_start) / count
+            # The api only takes whole minutes
+            bounds = [(gap_start + step * i).replace(second=0, microsecond=0) for i in range(count)] + [gap_end]
+            lanes += [(sensor, plan, lane_start, lane_end) for lane_start, lane_end in zip(bounds, bounds[1:])]
+    return lanes
+
+
+def backfill_unit(writer, sensor, plan, start, end):
+    '''
+    Fetch and write the data of one device in [start, end].
+    Returns the number of points, records and records which failed to be written.
+    '''
+    device_data = sensor_data.get_device_data(sensor["id"], format_time(start), format_time(end))
+    records = list(sensor_data.extract_device_records(device_data, plan))
+    failed = 0
+    for window_i in range(0, len(records), BATCH_SIZE):
+        failed += writer.write_batch(records[window_i: window_i + BATCH_SIZE])
+    return len(device_data), len(records), failed
+
+
+def backfill(start, end, ids=None, workers=8, checkpoint_path="backfill_checkpoint.json",
+             target_points=10000, initial_chunk=timedelta(days=1)):
+    '''
+    Backfill all devices, or the given ids, between start and end.
+    '''
+    checkpoint = FileStateStore(checkpoint_path)
+    sensors = [(sensor, plan) for sensor, plan in sensor_data.load_sensors() if ids is None or sensor['id'] in ids]
+    if len(sensors) == 0:
+        raise ValueError("The specified ids has no matching schemas.")
+    lanes = split_lanes(sensors, checkpoint, start, end, workers, initial_chunk)
+    total = sum((lane_end - lane_start for _, _, lane_start, lane_end in lanes), timedelta())
+    if total == timedelta():
+        print("Nothing to backfill, every chunk is in the checkpoint", checkpoint_path)
+        return
+    chunk_sizes = {sensor["id"]: initial_chunk for sensor, _ in sensors}
+    completed = timedelta()
+    written = 0
+    began = time.perf_counter()
+    pending = {}
+
+    with sensor_data.create_writer() as writer, ThreadPoolExecutor(max_workers=workers) as executor:
+        def submit(sensor, plan, lane_start, lane_end):
+            unit_end = min(lane_end, lane_start + chunk_sizes[sensor["id"]])
+            future = executor.submit(backfill_unit, writer, sensor, plan, lane_start, unit_end)
+            pending[future] = (sensor, plan, lane_start, unit_end, lane_end)
+
+        try:
+            for lane in lanes:
+                submit(*lane)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    sensor, plan, unit_start, unit_end, lane_end = pending.pop(future)
+                    try:
+                        points, records, failed = future.result()
+                    except Exception as err:
+                        print(f"Error backfilling device {sensor['id']} {format_time(unit_start)}/{format_time(unit_end)}:", err)
+                    else:
+                        # A chunk with failed records is fetched again on the next run
+                        if failed == 0:
+                            mark_done(checkpoint, sensor["id"], unit_start, unit_end)
+                        chunk_sizes[sensor["id"]] = next_chunk_size(unit_end - unit_start, points, target_points)
+                        completed += unit_end - unit_start
+                        written += records - failed
+                        elapsed = time.perf_counter() - began
+                        print(f"[{completed / total:6.1%}] device {sensor['id']} {format_time(unit_start)}/{format_time(unit_end)}: "
+                              f"{points} points, {written / elapsed:.0f} records/s")
+                    if unit_end < lane_end:
+                        submit(sensor, plan, unit_end, lane_end)
+        except KeyboardInterrupt:
+            print("Interrupted, run again with the same checkpoint to resume")
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+    print("WriteRecords Summary:", writer.summary)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-d", "--days", type=int, help="backfill the last number of days")
+    parser.add_argument("--start", type=parse_time, help=f"start of the backfill, {TIME_FORMAT} in UTC")
+    parser.add_argument("--end", type=parse_time, help=f"end of the backfill, {TIME_FORMAT} in UTC, default now")
+    parser.add_argument("--ids", type=int, nargs='*')
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.json")
+    parser.add_argument("--target-points", type=int, default=10000, help="points to fetch per request")
+    args = parser.parse_args()
+    if (args.days is None) == (args.start is None):
+        parser.error("one of -d/--days and --start is required")
+
+    end = args.end or datetime.now(timezone.utc).replace(second=0, microsecond=0)
+    start = args.start or end - timedelta(days=args.days)
+    backfill(start, end, args.ids, args.workers, args.checkpoint, args.target_points)
@@ -1,9 +1,16 @@
 import os
-import requests
 from datetime import timedelta, datetime, timezone
 import json
-import boto3
 import sys
+from operator import itemgetter
+from zoneinfo import ZoneInfo
+from common import http_client, metrics
+from common.fetch import fetch_concurrently
+from common.pipeline import BatchPipeline
+from common.records import Record
+from common.state import open_state_store
+from common.timestamps import iso_to_epoch_ms
+from common.sinks import open_sink
 
 # Define timestream supported datatypes
 TIMESTREAM_DATATYPES = ("DOUBLE", "BIGINT", "VARCHAR", "BOOLEAN")
@@ -14,6 +21,23 @@ DATABASE_NAME = os.environ["DATABASE_NAME"]
 TABLE_NAME = os.environ["TABLE_NAME"]
 COMPANY_ID = os.environ["COMPANY_ID"]
 TIME_DELTA = int(os.environ["TIME_DELTA"])
+# Base url of the BlueTrack API, can be overridden to run against a local server
+BLUETRACK_URL = os.getenv("BLUETRACK_URL", "http://api.norbitiot.com")
+# Maximum number of devices fetched at the same time
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT") or 8)
+# Maximum number of requests per second to BlueTrack, lowered while it answers 429 Too Many Requests
+REQUESTS_PER_SECOND = float(os.getenv("REQUESTS_PER_SECOND") or 20)
+# Seconds a single device may use before it is skipped
+DEVICE_TIMEOUT = float(os.getenv("DEVICE_TIMEOUT") or 30)
+# Timezone of the BlueTrack timestamps without an offset, previously the local time of the host
+BLUETRACK_TIMEZONE = os.getenv("BLUETRACK_TIMEZONE") or "UTC"
+BLUETRACK_TIMEZONE = timezone.utc if BLUETRACK_TIMEZONE == "UTC" else ZoneInfo(BLUETRACK_TIMEZONE)
+# Where the watermark of each device is stored, e.g. file:/tmp/watermarks.json. Unset to always fetch TIME_DELTA minutes
+WATERMARK_STORE = os.getenv("WATERMARK_STORE")
+# Maximum minutes a device with a watermark is fetched back in time, when catching up after an outage
+MAX_CATCH_UP = int(os.getenv("MAX_CATCH_UP") or 1440)
+# Where the records are written, timestream or parquet:<directory>
+SINK = os.getenv("SINK", "timestream")
 
 assert SECRET
 assert ACCESS_KEY
@@ -25,97 +49,180 @@ AUTH_HEADERS = {
     "X-API-KEY": ACCESS_KEY
 } 
 
-def get_measurement(data, schema):
+# Sensors and their compiled schemas, loaded once per lambda container
+_sensors = None
+# Store of the device watermarks, opened once per lambda container
+_state_store = None
+
+def compile_schema(sensor_schema):
     '''
-    Get the measurement data from the data defined by the schema.
+    Compile the nested schema of a sensor into a flat extraction plan.
+    Each step in the plan holds the key path to a nested object, a getter returning
+    the measurement values in that object and the names and types of the measurements.
     '''
-    measurements = []
-    for key, value in schema.items():
-        if isinstance(value, str):
-            measurements.append((key, data[key], value))
-        elif isinstance(value, dict):
-            measurements += get_measurement(data[key],value)
-        else:
-            raise ValueError
-    return measurements
+    fields = {}
+    def walk(schema, path):
+        for key, value in schema.items():
+            if isinstance(value, str):
+                fields.setdefault(path, []).append((key, value))
+            elif isinstance(value, dict):
+                walk(value, path + (key,))
+            else:
+                raise ValueError
+    walk(sensor_schema, ())
+
+    plan = []
+    for path, measurements in fields.items():
+        keys = [key for key, _ in measurements]
+        # itemgetter returns a bare value instead of a tuple for a single key
+        getter = itemgetter(*keys) if len(keys) > 1 else (lambda data, key=keys[0]: (data[key],))
+        plan.append((path, getter, tuple(measurements)))
+    return plan
 
-def extract_device_records(device_data, sensor_schema):
+def load_sensors():
     '''
-    Extracts the corresponding timestream records from the sensor data.
+    Load the sensors from sensor_data.json with their compiled schemas.
+    The result is kept at module scope, so warm lambda invocations reuse it.
+    '''
+    global _sensors
+    if _sensors is None:
+        with open("sensor_data.json") as sensor_data_schema:
+            _sensors = [(sensor, compile_schema(sensor["data"])) for sensor in json.load(sensor_data_schema)]
+    return _sensors
+
+def extract_device_records(device_data, plan):
     '''
-    records = []
+    Extracts the corresponding timestream records from the sensor data using a compiled schema.
+    The records are yielded one at a time as the device data is parsed.
+    '''
+    # The names and types of the measures follow the plan, so they are shared between all records
+    measures = tuple(measurement for _, _, measurements in plan for measurement in measurements)
+    # The dimensions are the same for all rows from a device, so they are shared between its records
+    dimensions_by_ids = {}
     for data in device_data:
         measure_values = []
-        measurements = get_measurement(data, sensor_schema)
-        for measurement in measurements:
-            measure_values.append({'Name': measurement[0], 'Value': str(measurement[1]), 'Type': measurement[2]})
-        record = {
-            'Dimensions': [
-                {'Name': 'gateway_id', 'Value': str(data['gatewayId'])},
-                {'Name': 'tagId', 'Value': str(data['deviceId'])},
-            ],
-            'Time': str(int(round(datetime.strptime(data['timestamp'], '%Y-%m-%dT%H:%M:%S.%f').timestamp()*1000))),
-            'MeasureName': 'sensor_measurements',
-            'MeasureValueType': 'MULTI',
-            'MeasureValues': measure_values
-        }
-        if len(measure_values) != 0:
-            records.append(record)
-    return records
+        for path, getter, _ in plan:
+            values = data
+            for key in path:
+                values = values[key]
+            measure_values += getter(values)
+        if len(measure_values) == 0:
+            continue
+        ids = (data['gatewayId'], data['deviceId'])
+        dimensions = dimensions_by_ids.get(ids)
+        if dimensions is None:
+            dimensions = dimensions_by_ids[ids] = [
+                {'Name': 'gateway_id', 'Value': str(ids[0])},
+                {'Name': 'tagId', 'Value': str(ids[1])},
+            ]
+        yield Record(dimensions, iso_to_epoch_ms(data['timestamp'], BLUETRACK_TIMEZONE),
+                     'sensor_measurements', measures, tuple(measure_values))
 
 def get_device_data(device_id, start_time, end_time):
-    res = requests.get(f"http://api.norbitiot.com/api/td/device/{COMPANY_ID}/{device_id}/period/{start_time}/{end_time}", headers=AUTH_HEADERS).json()
-    return res
+    with metrics.timer("fetch", device_id):
+        res = http_client.get(f"{BLUETRACK_URL}/api/td/device/{COMPANY_ID}/{device_id}/period/{start_time}/{end_time}",
+                              headers=AUTH_HEADERS, timeout=(http_client.CONNECT_TIMEOUT, DEVICE_TIMEOUT),
+                              max_connections=MAX_IN_FLIGHT, requests_per_second=REQUESTS_PER_SECOND)
+    res.raise_for_status()
+    with metrics.timer("parse", device_id):
+        return res.json()
 
-def fetch_and_insert_sensor_data(start_time, end_time, ids=None):
+def fetch_sensor_records(start_time, end_time, ids=None, watermarks=None):
     '''
-    Fetch sensor data from the defined ids and insert it into the database.
+    Fetch sensor data from the defined ids and yield the records as each device is parsed.
+    With `watermarks`, a dict from device id to the time in epoch ms of the newest ingested
+    row, a device is fetched from its watermark instead of start_time, rows at or before the
+    watermark are skipped and the watermark is moved to the newest row yielded.
     '''
-    sensor_data_schema = open("sensor_data.json")
-    schema = json.load(sensor_data_schema)
-    records = []
-    for sensor in schema:
-        if ids is not None and sensor['id'] not in ids:
+    def device_start_time(sensor):
+        watermark = watermarks.get(sensor["id"]) if watermarks is not None else None
+        if watermark is None:
+            return start_time
+        # The api takes whole minutes, rows before the watermark in that minute are skipped below
+        return max(start_time, datetime.fromtimestamp(watermark / 1000, timezone.utc).strftime("%Y-%m-%dT%H:%M"))
+
+    sensors = [(sensor, plan) for sensor, plan in load_sensors() if ids is None or sensor['id'] in ids]
+    # Fetch the devices concurrently, a device that fails or times out is skipped
+    fetched = fetch_concurrently(lambda sensor: get_device_data(sensor[0]["id"], device_start_time(sensor[0]), end_time),
+                                 sensors, max_in_flight=MAX_IN_FLIGHT, timeout=DEVICE_TIMEOUT)
+    for (sensor, plan), device_data, err in fetched:
+        if err is not None:
+            print(f"Error fetching device {sensor['id']}:", err)
+            metrics.count("fetch_errors")
+            continue
+        records = metrics.timed("transform", sensor['id'], extract_device_records(device_data, plan))
+        if watermarks is None:
+            yield from records
             continue
-        else:
-            records += extract_device_records(get_device_data(sensor["id"], start_time, end_time), sensor["data"])
-    if len(records) == 0:
+        watermark = newest = watermarks.get(sensor['id'], -1)
+        for record in records:
+            if record.time > watermark:
+                newest = max(newest, record.time)
+                yield record
+        watermarks[sensor['id']] = newest
+
+def create_writer():
+    '''
+    Create the writer inserting batches of records into the sink defined by SINK, timestream by default.
+    '''
+    return open_sink(SINK, DATABASE_NAME, TABLE_NAME, source="sensor_data", device_dimension="tagId")
+
+def fetch_and_insert_sensor_data(start_time, end_time, ids=None, watermarks=None):
+    '''
+    Fetch sensor data from the defined ids and insert it into the database.
+    Returns the summary of the written records.
+    '''
+    # Batches are written while the next devices are fetched
+    with create_writer() as writer, BatchPipeline(writer.submit) as pipeline:
+        pipeline.extend(fetch_sensor_records(start_time, end_time, ids, watermarks))
+    print("WriteRecords Summary:", writer.summary)
+    metrics.record_summary(writer.summary, pipeline.count)
+    # Without watermarks there should always be new data, with them an empty run is normal
+    if pipeline.count == 0 and watermarks is None:
         raise ValueError("The specified ids has no matching schemas.")
+    return writer.summary
+
+def get_state_store():
+    '''
+    Open the store of the device watermarks defined by WATERMARK_STORE, once per lambda container.
+    '''
+    global _state_store
+    if _state_store is None and WATERMARK_STORE:
+        _state_store = open_state_store(WATERMARK_STORE)
+    return _state_store
+
+def sync_sensor_data(store, now):
+    '''
+    Fetch every device from its watermark up to now, at most MAX_CATCH_UP minutes back,
+    and store the new watermarks once the records are written.
+    A device without a watermark is fetched from TIME_DELTA minutes back.
+    '''
+    end_time = now.strftime("%Y-%m-%dT%H:%M")
+    start_time = (now - timedelta(minutes=MAX_CATCH_UP)).strftime("%Y-%m-%dT%H:%M")
+    default_watermark = int((now - timedelta(minutes=TIME_DELTA)).timestamp() * 1000)
+    watermarks = {sensor['id']: store.get(str(sensor['id']), default_watermark) for sensor, _ in load_sensors()}
+    summary = fetch_and_insert_sensor_data(start_time, end_time, watermarks=watermarks)
+    if summary.failed != 0:
+        # Keep the old watermarks so the next run fetches the failed records again
+        print("Records failed to be written, the watermarks are not moved")
+        return
+    store.update({str(device_id): watermark for device_id, watermark in watermarks.items()})
 
-    client = boto3.client("timestream-write")
-    # If the number of records is too high the uploads will have to be batched
-    for window_i in range(0, len(records), 100):
-        record_window = records[window_i: window_i + 100]
-        try:
-            result = client.write_records(DatabaseName=DATABASE_NAME, TableName=TABLE_NAME,
-                                                Records=record_window, CommonAttributes={})
-            print("WriteRecords Status: [%s]" % result['ResponseMetadata']['HTTPStatusCode'])
-        except client.exceptions.RejectedRecordsException as err:
-            print(err)
-        except Exception as err:
-            print("Error:", err)
- 
 # The entrypoint for the aws lambda
 def lambda_handler(event=None, context=None):
-    now = datetime.now(timezone.utc) 
-    now_min_delta = now - timedelta(minutes=TIME_DELTA)
-    start_time = now_min_delta.strftime("%Y-%m-%dT%H:%M")
-    end_time = now.strftime("%Y-%m-%dT%H:%M")
-    fetch_and_insert_sensor_data(start_time, end_time)
+    # The timings and counts of the invocation are logged as a single line when it ends
+    with metrics.invocation("sensor_data", breakdown="devices"):
+        now = datetime.now(timezone.utc)
+        store = get_state_store()
+        if store is not None:
+            sync_sensor_data(store, now)
+            return
+        now_min_delta = now - timedelta(minutes=TIME_DELTA)
+        start_time = now_min_delta.strftime("%Y-%m-%dT%H:%M")
+        end_time = now.strftime("%Y-%m-%dT%H:%M")
+        fetch_and_insert_sensor_data(start_time, end_time)
     
-# Main script if the program should be run as a cli
+# Main script if the program should be run as a cli, backfilling the given number of days
 if __name__ == "__main__":
-    import argparse
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-d", "--days", required=True, type=int)
-    parser.add_argument("--ids", type=int, nargs='*')
-    args = parser.parse_args()
-
-    now = datetime.now(timezone.utc)
-    for day in range(1, args.days + 1):
-        now_min_delta = now - timedelta(days=day)
-        start_time = now_min_delta.strftime("%Y-%m-%dT%H:%M")
-        now_min_delta = now - timedelta(days=day-1)
-        end_time = now_min_delta.strftime("%Y-%m-%dT%H:%M")
-        print(start_time, end_time)
-        fetch_and_insert_sensor_data(start_time, end_time, args.ids)
+    from backfill import main
+    main()
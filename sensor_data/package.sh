@@ -8,3 +8,4 @@ zip -r ../$package_name.zip .
 cd ..
 zip -g $package_name.zip lambda_function.py
 zip -g $package_name.zip sensor_data.json
+zip -r $package_name.zip common -x "*__pycache__*"
@@ -1,10 +1,16 @@
 import os
-import requests
 from datetime import datetime
 import json
-import boto3
+import time
 import math
+from email.utils import parsedate_to_datetime
 from dotenv import load_dotenv
+from common import http_client, metrics
+from common.fetch import fetch_concurrently
+from common.pipeline import BatchPipeline
+from common.records import Record
+from common.state import open_state_store
+from common.sinks import open_sink
 
 load_dotenv()
 
@@ -13,114 +19,197 @@ TIMESTREAM_DATATYPES = ("DOUBLE", "BIGINT", "VARCHAR", "BOOLEAN")
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 TABLE_NAME = os.getenv("TABLE_NAME")
 
+# Url of the locationforecast API, can be overridden to run against a local server
+FORECAST_URL = os.getenv("FORECAST_URL", "https://api.met.no/weatherapi/locationforecast/2.0/compact.json")
+# Where the caching headers of the forecasts are stored, file:<path> or sqlite:<path>. Empty to disable
+FORECAST_CACHE = os.getenv("FORECAST_CACHE", "file:/tmp/yr_forecast_cache.json")
+# Maximum number of forecasts fetched at the same time
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT") or 10)
+# Maximum number of requests per second to met.no, which allows at most 20. Lowered while it answers 429
+REQUESTS_PER_SECOND = float(os.getenv("REQUESTS_PER_SECOND") or 10)
+# Number of hours of the forecast which are stored
+FORECAST_HOURS = 24
+# Where the records are written, timestream or parquet:<directory>
+SINK = os.getenv("SINK", "timestream")
+
 assert DATABASE_NAME
 assert TABLE_NAME
 
-def get_measurement(data, time_delta: int):
-    """Extract measurements from json object
+# Positions from yr_position.json, loaded once per lambda container
+_positions = None
+# Cache of the forecast caching headers, opened once per lambda container
+_forecast_cache = None
+
+# Names of the measures of a forecast, in the order of the values from `forecast_to_measure_values`
+MEASURE_NAMES = [f"{time_delta}h_{name}" for time_delta in range(1, FORECAST_HOURS + 1)
+                 for name in ["air_temperature", "relative_humidity", "wind_speed",
+                              "wind_direction_cos", "wind_direction_sin", "percipitation"]]
+# Names and types of the measures of a forecast, shared by all its records
+MEASURES = tuple((name, "DOUBLE") for name in MEASURE_NAMES)
+
+def forecast_to_measure_values(yr_data):
+    """Extract the measurements of the next 24 hours from a forecast
+
+    The values are collected column by column over the timeseries.
 
-    :param data: json-object to extract data from
-    :param time_delta: prediction for time_delta hours in the future
-    :return: measurements to be inserted into timestream
+    :param yr_data: forecast json from yr.no
+    :return: values of the measurements to be inserted into timestream, in the order of `MEASURES`
     """
-    measurements = []
-    for name in ["air_temperature", "relative_humidity", "wind_speed"]:
-        measurements.append({
-            "Name": f"{time_delta}h_{name}",
-            "Value": str(data["data"]["instant"]["details"][name]),
-            "Type": "DOUBLE"
-        })
-    
+    timeseries = yr_data["properties"]["timeseries"][:FORECAST_HOURS]
+    details = [data["data"]["instant"]["details"] for data in timeseries]
     # wind direction is set together of sin and cos to avoid 359 -> 0 
-    wind_direction = float(data["data"]["instant"]["details"]["wind_from_direction"])
-    cos_val = math.cos(math.radians(wind_direction))
-    sin_val = math.sin(math.radians(wind_direction))
-    measurements.append({
-        "Name": f"{time_delta}h_wind_direction_cos",
-        "Value": str(cos_val),
-        "Type": "DOUBLE"
-    })
-    measurements.append({
-        "Name": f"{time_delta}h_wind_direction_sin",
-        "Value": str(sin_val),
-        "Type": "DOUBLE"
-    })
-    measurements.append({
-        "Name": f"{time_delta}h_percipitation",
-        "Value": str(data["data"]["next_1_hours"]["details"]["precipitation_amount"]),
-        "Type": "DOUBLE"
-    })
-    return measurements
-
-def get_and_extract_yr_data(lat: float, lon: float, gateway_id: int):
-    """Gets the predicted data from yr.no by using the API to yr.no,
-    and returns the rows to be inserted to the timestream database
-
-    :param lat: Lat of the gateway, to be stored in the database. Used for finding weather forecast
-    :param lon: Lon of the gateway, to be stored in the database. Used for finding weather forecast
-    :param gateway_id: Gateway id to be stored in the database
-    :return: rows to be inserted into database
+    wind_direction = [math.radians(detail["wind_from_direction"]) for detail in details]
+    columns = [
+        [detail["air_temperature"] for detail in details],
+        [detail["relative_humidity"] for detail in details],
+        [detail["wind_speed"] for detail in details],
+        [math.cos(radians) for radians in wind_direction],
+        [math.sin(radians) for radians in wind_direction],
+        [data["data"]["next_1_hours"]["details"]["precipitation_amount"] for data in timeseries],
+    ]
+    # one row of values per hour, flattened in the order of MEASURE_NAMES
+    return tuple(value for row in zip(*columns) for value in row)
+
+
+def get_forecast(lat: float, lon: float):
+    """Gets the forecast for a position from yr.no, honouring the caching headers of the API.
+
+    The Expires and Last-Modified headers of the last stored response are kept in the forecast
+    cache. Before the forecast expires no request is sent, after that a conditional request is sent.
+    The headers of the response are returned rather than cached here, they are cached once the
+    forecast is written, so a forecast which failed to be written is fetched again on the next run.
+
+    :param lat: Lat rounded to 4 decimals, the precision the API accepts
+    :param lon: Lon rounded to 4 decimals, the precision the API accepts
+    :return: tuple of the forecast json, or None when the forecast has not changed since the last
+        run, and the cache entry of the response, or None when nothing is to be cached
     """
     # Must be included to not get 403 error
     header = {
         'User-Agent': 'NorbitMose github.com/kundestyrt-norbit',
     }
-    # Yr.no API states that lat lon only should have 4 decimal precision
-    yr_data = requests.get(f"https://api.met.no/weatherapi/locationforecast/2.0/compact.json?lat={round(lat, 4)}&lon={round(lon, 4)}", headers=header).json()
-    records = []
-    measure_values = []
-    # get prediction for next 24 hours
-    for i, data in enumerate(yr_data["properties"]["timeseries"]):
-        if i < 24:
-            measure_values.extend(get_measurement(data=data,time_delta=i+1))
-    record = {
-        'Dimensions': [
-            {'Name': 'lat', 'Value': str(lat)},
-            {'Name': 'lon', 'Value': str(lon)},
-            {'Name': 'gateway_id', 'Value': str(gateway_id)},
-
-        ],
-        'Time': str(int(round(datetime.now().replace(second=0, microsecond=0, minute=0).timestamp()*1000))),
-        'MeasureName': 'yr_prediction',
-        'MeasureValueType': 'MULTI',
-        'MeasureValues': measure_values
-    }
+    cache = get_forecast_cache()
+    key = f"{lat},{lon}"
+    cached = cache.get(key) if cache is not None else None
+    if cached is not None:
+        if time.time() < cached["expires"]:
+            print(f"Forecast for {key} has not expired, skipping")
+            return None, None
+        if cached.get("last_modified"):
+            header['If-Modified-Since'] = cached["last_modified"]
+
+    # met.no limits the number of requests per second of an application, the rate is lowered when it throttles
+    with metrics.timer("fetch", key):
+        response = http_client.get(f"{FORECAST_URL}?lat={lat}&lon={lon}", headers=header, max_connections=MAX_IN_FLIGHT,
+                                   requests_per_second=REQUESTS_PER_SECOND)
+    response.raise_for_status()
+    cache_entry = None
+    if cache is not None:
+        expires = response.headers.get("Expires")
+        cache_entry = {
+            "expires": parsedate_to_datetime(expires).timestamp() if expires else 0,
+            "last_modified": response.headers.get("Last-Modified") or (cached or {}).get("last_modified"),
+        }
+    if response.status_code == 304:
+        print(f"Forecast for {key} has not been modified, skipping")
+        return None, cache_entry
+    with metrics.timer("parse", key):
+        return response.json(), cache_entry
+
+
+def extract_forecast_records(measure_values, lat: float, lon: float, gateway_id: int, timestamp: int):
+    """Returns the rows to be inserted to the timestream database for a gateway
+
+    :param measure_values: values from `forecast_to_measure_values`
+    :param lat: Lat of the gateway, to be stored in the database
+    :param lon: Lon of the gateway, to be stored in the database
+    :param gateway_id: Gateway id to be stored in the database
+    :param timestamp: time of the forecast in epoch ms
+    :return: generator of rows to be inserted into database
+    """
+    dimensions = [
+        {'Name': 'lat', 'Value': str(lat)},
+        {'Name': 'lon', 'Value': str(lon)},
+        {'Name': 'gateway_id', 'Value': str(gateway_id)},
+    ]
     if len(measure_values) != 0:
-        records.append(record)
-    # print(record)
-    return records
+        yield Record(dimensions, timestamp, 'yr_prediction', MEASURES, measure_values)
+
+
+def get_forecast_measure_values(position):
+    """Get the measurements of the forecast for a rounded (lat, lon) position, or None when the
+    forecast has not changed since the last run, together with the cache entry from `get_forecast`"""
+    yr_data, cache_entry = get_forecast(*position)
+    if yr_data is None:
+        return None, cache_entry
+    with metrics.timer("transform", "{},{}".format(*position)):
+        return forecast_to_measure_values(yr_data), cache_entry
+
+
+def get_forecast_cache():
+    """Open the forecast cache defined by FORECAST_CACHE, once per lambda container"""
+    global _forecast_cache
+    if _forecast_cache is None and FORECAST_CACHE:
+        _forecast_cache = open_state_store(FORECAST_CACHE)
+    return _forecast_cache
+
+
+def load_positions():
+    """Load the positions to get yr data from, once per lambda container"""
+    global _positions
+    if _positions is None:
+        with open("yr_position.json") as positions:
+            _positions = json.load(positions)
+    return _positions
 
 
 def fetch_and_insert_sensor_data(names=None):
-    # load positions to get yr data from
-    positions = open("yr_position.json")
-    schema = json.load(positions)
-    records = []
-
-    for point in schema:
-        # for cli usage for one or multiple points
-        if names is not None and point['name'] not in names:
-            continue
-        else:
-            records += get_and_extract_yr_data(lat=point['lat'], lon=point['lon'], gateway_id=point['gatewayId'])
-    if len(records) == 0:
+    points = [point for point in load_positions() if names is None or point['name'] in names]
+    if len(points) == 0:
         raise ValueError("The specified ids has no matching schemas.")
 
-    client = boto3.client("timestream-write")
-    for window_i in range(0, len(records), 100):
-        record_window = records[window_i: window_i + 100]
-        try:
-            result = client.write_records(DatabaseName=DATABASE_NAME, TableName=TABLE_NAME,
-                                                Records=record_window, CommonAttributes={'Version': round(datetime.now().timestamp())})
-            print("WriteRecords Status: [%s]" % result['ResponseMetadata']['HTTPStatusCode'])
-        except client.exceptions.RejectedRecordsException as err:
-            print(err.response)
-        except Exception as err:
-            print("Error:", err)
+    # the version makes a new run overwrite the previous values at the same time
+    writer = open_sink(SINK, DATABASE_NAME, TABLE_NAME, source="yr_future", device_dimension="gateway_id",
+                       common_attributes=lambda: {'Version': round(datetime.now().timestamp())})
+    # gateways are grouped by rounded position, so gateways at the same position share a request
+    points_by_position = {}
+    for point in points:
+        # Yr.no API states that lat lon only should have 4 decimal precision
+        points_by_position.setdefault((round(point['lat'], 4), round(point['lon'], 4)), []).append(point)
+    timestamp = int(round(datetime.now().replace(second=0, microsecond=0, minute=0).timestamp()*1000))
+    # caching headers of the fetched forecasts, cached once the forecasts are written
+    cache_entries = {}
+    # batches are written while the next positions are fetched
+    with writer, BatchPipeline(writer.submit) as pipeline:
+        fetched = fetch_concurrently(get_forecast_measure_values, list(points_by_position), max_in_flight=MAX_IN_FLIGHT)
+        for position, result, err in fetched:
+            if err is not None:
+                print(f"Error fetching forecast for {position}:", err)
+                metrics.count("fetch_errors")
+                continue
+            measure_values, cache_entry = result
+            if cache_entry is not None:
+                cache_entries["{},{}".format(*position)] = cache_entry
+            if measure_values is None:
+                continue
+            for point in points_by_position[position]:
+                records = extract_forecast_records(measure_values, lat=point['lat'], lon=point['lon'],
+                                                   gateway_id=point['gatewayId'], timestamp=timestamp)
+                pipeline.extend(metrics.timed("transform", "{},{}".format(*position), records))
+    print("WriteRecords Summary:", writer.summary)
+    metrics.record_summary(writer.summary, pipeline.count)
+    cache = get_forecast_cache()
+    if cache is not None and cache_entries:
+        if writer.summary.failed != 0:
+            # Keep the old caching headers so the next run fetches the forecasts again
+            print("Records failed to be written, the forecast cache is not updated")
+        else:
+            cache.update(cache_entries)
  
 def lambda_handler(event=None, context=None):
-    """Handler for lambda function"""
-    fetch_and_insert_sensor_data()
+    """Handler for lambda function, logging the timings and counts of the invocation when it ends"""
+    with metrics.invocation("yr_future", breakdown="positions"):
+        fetch_and_insert_sensor_data()
     
 
 if __name__ == "__main__":
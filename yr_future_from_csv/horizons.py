@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+
+HORIZONS = 24
+
+
+def horizon_column(column, horizon):
+    return f"{horizon}h_{column}"
+
+
+def shift_horizons(df: pd.DataFrame, columns, horizons=HORIZONS, fill_value=np.nan):
+    """Replace each column with the columns `<h>h_<column>`, holding the value of the column h rows later.
+
+    The rows are expected to be hourly and sorted by time, so the value h rows later is the
+    value h hours ahead. The last rows have no value h rows later for the largest horizons,
+    those get fill_value.
+
+    :param columns: names of the columns to shift
+    :param horizons: number of horizons, from 1 to horizons rows later
+    :return: a new frame, with the shifted columns after the other columns
+    """
+    rows = len(df)
+    blocks = {}
+    for column in columns:
+        values = df[column].to_numpy(dtype=np.float64)
+        block = np.full((rows, horizons), fill_value, dtype=np.float64)
+        # Horizons reaching past the last row are left at fill_value
+        for horizon in range(1, min(horizons, rows - 1) + 1):
+            block[:rows - horizon, horizon - 1] = values[horizon:]
+        blocks[column] = block
+    shifted = {horizon_column(column, horizon): blocks[column][:, horizon - 1]
+               for horizon in range(1, horizons + 1) for column in columns}
+    return pd.concat([df.drop(columns=list(columns)), pd.DataFrame(shifted, index=df.index)], axis=1)
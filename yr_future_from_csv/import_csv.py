@@ -0,0 +1,140 @@
+"""
+Streaming import of the forecasts of WeatherForecast.csv into TimeStream.
+
+The csv is read in chunks, each chunk is optionally merged with the wind direction
+horizons of the past table, turned into records column by column, and handed to a
+batch writer writing several batches concurrently. Only a few chunks are in memory
+at a time, however large the export is.
+
+    python import_csv.py WeatherForecast.csv --past-days 60
+    python import_csv.py WeatherForecast.csv --dry-run
+"""
+import argparse
+import datetime as dt
+import os
+import time
+
+import numpy as np
+import pandas as pd
+from dotenv import load_dotenv
+
+from common.pipeline import BatchPipeline
+from common.records import Record, to_boto_records
+from common.timestream import TimestreamWriter, get_write_client
+from horizons import shift_horizons
+
+EPOCH = pd.Timestamp("1970-01-01")
+MEASURE_NAME = 'yr_prediction'
+PAST_COLUMNS = ["wind_direction_sin", "wind_direction_cos"]
+
+
+def read_chunks(path, chunk_rows):
+    """Read the csv in chunks of chunk_rows rows, with the time in UTC without a timezone."""
+    for chunk in pd.read_csv(path, chunksize=chunk_rows):
+        chunk["time"] = pd.to_datetime(chunk["time"], utc=True).dt.tz_localize(None)
+        yield chunk
+
+
+def get_past_horizons(client, database, table, days, cache=None):
+    """Query the wind direction of the last days from the past table, with a column per horizon."""
+    import timestreamquery as timestream
+
+    query = f"""
+    SELECT time, wind_direction_sin, wind_direction_cos
+    FROM {database}.{table}
+    WHERE time > ago({days}d)
+    """
+    if cache is not None:
+        df = timestream.executeCachedQuery(client, cache, query, True)
+    else:
+        df = timestream.executeQueryAndReturnAsDataframe(client, query, True)
+    df = df.sort_values("time", ignore_index=True)
+    df["time"] = pd.to_datetime(df["time"])
+    return shift_horizons(df, PAST_COLUMNS)
+
+
+def get_records(df: pd.DataFrame, lat=63.44256, lon=10.4285, gateway_id=8):
+    """Build the timestream records of a frame indexed by time, column by column.
+
+    Every column is a DOUBLE measure. Measures without a value are left out, and a row
+    without any values gives no record.
+
+    :return: generator of rows to be inserted into database
+    """
+    names = list(df.columns)
+    values = df.to_numpy(dtype=float)
+    present = ~np.isnan(values)
+    times = ((df.index - EPOCH) // pd.Timedelta(milliseconds=1)).tolist()
+
+    dimensions = [
+        {'Name': 'lat', 'Value': str(lat)},
+        {'Name': 'lon', 'Value': str(lon)},
+        {'Name': 'gateway_id', 'Value': str(gateway_id)},
+    ]
+    # Rows with the same measures present share the names and types of their measures
+    measures_by_present = {}
+    for timestamp, row_values, row_present in zip(times, values.tolist(), present.tolist()):
+        if not any(row_present):
+            continue
+        key = tuple(row_present)
+        measures = measures_by_present.get(key)
+        if measures is None:
+            measures = measures_by_present[key] = tuple(
+                (name, "DOUBLE") for name, is_present in zip(names, row_present) if is_present)
+        yield Record(dimensions, timestamp, MEASURE_NAME, measures,
+                     tuple(value for value, is_present in zip(row_values, row_present) if is_present))
+
+
+def import_csv(path, write_batch, chunk_rows=10000, past=None):
+    """Stream the records of the csv into write_batch.
+
+    :param past: frame from `get_past_horizons` merged into every chunk, or None
+    :return: number of records
+    """
+    began = time.perf_counter()
+    rows = 0
+    with BatchPipeline(write_batch) as pipeline:
+        for chunk in read_chunks(path, chunk_rows):
+            if past is not None:
+                chunk = chunk.merge(past, on="time", how="left")
+            pipeline.extend(get_records(chunk.set_index("time")))
+            rows += len(chunk)
+            elapsed = time.perf_counter() - began
+            print(f"{rows} rows, {pipeline.count} records, {pipeline.count / elapsed:.0f} records/s")
+    return pipeline.count
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import the forecasts of a csv export into TimeStream.")
+    parser.add_argument("csv", nargs="?", default="WeatherForecast.csv")
+    parser.add_argument("--chunk-rows", type=int, default=10000, help="rows of the csv read at a time")
+    parser.add_argument("--workers", type=int, default=4, help="batches written concurrently")
+    parser.add_argument("--past-days", type=int, default=0,
+                        help="merge the wind direction horizons of the last days of the past table")
+    parser.add_argument("--dry-run", action="store_true", help="build the records without writing them")
+    args = parser.parse_args()
+
+    load_dotenv()
+    past = None
+    if args.past_days:
+        import timestreamquery as timestream
+        client = timestream.createQueryClient("eu-west-1", os.getenv("AWS_ACCESS_KEY_ID"), os.getenv("AWS_SECRET_ACCESS_KEY"))
+        past = get_past_horizons(client, os.getenv("DATABASE_NAME"), os.getenv("PAST_TABLE_NAME"), args.past_days,
+                                 timestream.QueryCache(".query_cache"))
+
+    began = time.perf_counter()
+    if args.dry_run:
+        count = import_csv(args.csv, to_boto_records, args.chunk_rows, past)
+        print(f"Dry run: {count} records in {time.perf_counter() - began:.1f} s, nothing was written")
+        return
+    database, table = os.getenv("DATABASE_NAME"), os.getenv("TABLE_NAME")
+    assert database and table, "DATABASE_NAME and TABLE_NAME must be set"
+    writer = TimestreamWriter(get_write_client(), database, table, max_workers=args.workers,
+                              common_attributes=lambda: {'Version': round(dt.datetime.now().timestamp())})
+    with writer:
+        import_csv(args.csv, writer.submit, args.chunk_rows, past)
+    print("WriteRecords Summary:", writer.summary)
+
+
+if __name__ == "__main__":
+    main()
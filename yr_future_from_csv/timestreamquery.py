@@ -7,9 +7,15 @@ import sys, traceback
 from timeit import default_timer as timer
 import datetime
 import pandas as pd
+import numpy as np
 import os
-from collections import defaultdict, namedtuple
+from collections import namedtuple
 import argparse
+import hashlib
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from common.state import FileStateStore
 
 '''
 ## Create a timestream query client.
@@ -81,33 +87,377 @@ def parseRowData(c_types, data):
         datum_dict[c_type['Name']] = parseDatum(c_type['Type'], elem)
     return datum_dict
 
+## Parsers of the scalar types, used for the values of nested columns.
+SCALAR_PARSERS = {
+    "VARCHAR": str,
+    "BIGINT": int,
+    "INTEGER": int,
+    "DOUBLE": float,
+    "BOOLEAN": lambda value: value == "true",
+}
+
+## Numpy types of the scalar columns converted in bulk, the other scalar types are kept as strings.
+SCALAR_DTYPES = {
+    "BIGINT": np.int64,
+    "INTEGER": np.int64,
+    "DOUBLE": np.float64,
+}
+
+def datumConverter(c_type):
+    """
+    Build the function parsing one datum of the given column type.
+    The type dict is only inspected once, instead of for every datum as in parseDatum.
+    """
+    if ('ScalarType' in c_type):
+        parse = SCALAR_PARSERS.get(c_type['ScalarType'])
+        if parse == None:
+            return lambda datum: datum.get('ScalarValue')
+        def convertScalar(datum):
+            value = datum.get('ScalarValue')
+            return None if value == None else parse(value)
+        return convertScalar
+    elif ('ArrayColumnInfo' in c_type):
+        convertElem = datumConverter(c_type['ArrayColumnInfo']['Type'])
+        def convertArray(datum):
+            data = datum.get('ArrayValue')
+            return None if data == None else [convertElem(elem) for elem in data]
+        return convertArray
+    elif ('TimeSeriesMeasureValueColumnInfo' in c_type):
+        convertValue = datumConverter(c_type['TimeSeriesMeasureValueColumnInfo']['Type'])
+        def convertTS(datum):
+            data = datum.get('TimeSeriesValue')
+            if data == None:
+                return None
+            return [{'time': elem['Time'], 'value': convertValue(elem['Value'])} for elem in data]
+        return convertTS
+    elif ('RowColumnInfo' in c_type):
+        fields = [(info['Name'], datumConverter(info['Type'])) for info in c_type['RowColumnInfo']]
+        def convertRow(datum):
+            data = datum.get('RowValue')
+            if data == None:
+                return None
+            return {name: convert(elem) for (name, convert), elem in zip(fields, data['Data'])}
+        return convertRow
+    else:
+        raise Exception("All the data is Null???")
+
+def columnConverter(c_type):
+    """
+    Build the function converting all the data of a column in a page.
+    Scalar columns are read in one pass, and numeric ones converted by numpy. Integer
+    columns with null values become float columns with NaN, as pandas would make them.
+    """
+    if ('ScalarType' not in c_type):
+        convert = datumConverter(c_type)
+        return lambda data: [convert(datum) for datum in data]
+    scalarType = c_type['ScalarType']
+    dtype = SCALAR_DTYPES.get(scalarType)
+    def convertScalars(data):
+        values = [datum.get('ScalarValue') for datum in data]
+        if (scalarType == "BOOLEAN"):
+            return [None if value == None else value == "true" for value in values]
+        if dtype == None:
+            return values
+        if dtype is np.int64 and None in values:
+            return np.array(values, dtype=np.float64)
+        return np.array(values, dtype=dtype)
+    return convertScalars
+
+def pageConverter(columnInfo):
+    """
+    Build the function translating the rows of a page into a Pandas dataframe.
+    """
+    names = [c_info['Name'] for c_info in columnInfo]
+    converters = [columnConverter(c_info['Type']) for c_info in columnInfo]
+    def convertPage(page):
+        rows = page.get('Rows', [])
+        if len(rows) == 0:
+            return pd.DataFrame(columns=names)
+        columns = zip(*(row['Data'] for row in rows))
+        return pd.DataFrame({name: convert(column) for name, convert, column in zip(names, converters, columns)})
+    return convertPage
+
+def iterateDataframes(pages):
+    """
+    Translate Timestream query SDK result pages into one Pandas dataframe per page.
+    The converters of the columns are chosen from the ColumnInfo of the first page.
+    """
+    convertPage = None
+    for page in pages:
+        if convertPage == None:
+            convertPage = pageConverter(page['ColumnInfo'])
+        yield convertPage(page)
+
 def flatModelToDataframe(items):
     """
     Translate a Timestream query SDK result into a Pandas dataframe.
     """
-    return_val = defaultdict(list)
-    for obj in items:
-        for row in obj.get('Rows'):
-            for c_info, data in zip(obj['ColumnInfo'], row['Data']):
-                c_name = c_info['Name']
-                c_type = c_info['Type']
-                return_val[c_name].append(parseDatum(c_type, data))
+    frames = list(iterateDataframes(items))
+    if len(frames) == 0:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+## Matches a `time > ago(60d)` predicate, the queries which end at now().
+AGO_PREDICATE = re.compile(r"\btime\s*>=?\s*(ago\(\s*(\d+)\s*(ns|us|ms|s|m|h|d)\s*\))", re.IGNORECASE)
+AGO_UNITS = {"ns": "nanoseconds", "us": "microseconds", "ms": "milliseconds", "s": "seconds",
+             "m": "minutes", "h": "hours", "d": "days"}
+## Queries whose rows depend on all the rows in the range can not be extended with the new rows,
+## and the rows of ordered queries can not be appended after each other.
+NOT_APPENDABLE = re.compile(r"\b(group\s+by|order\s+by|limit|distinct|over|count|sum|avg|min|max|approx_\w+)\b",
+                            re.IGNORECASE)
+## Matches ago() and now(), the queries whose result depends on when they are executed.
+RELATIVE_TIME = re.compile(r"\b(ago|now)\s*\(", re.IGNORECASE)
+## Matches the columns selected by a query.
+SELECT_LIST = re.compile(r"^\s*select\s+(.*?)\s+from\b", re.IGNORECASE | re.DOTALL)
 
-    df = pd.DataFrame(return_val)
+def normalizeQuery(query):
+    """
+    Collapse the whitespace of a query outside of string literals, so formatting does not change the cache key.
+    """
+    return re.sub(r"('(?:[^']|'')*')|\s+", lambda match: match.group(1) or " ", query).strip()
+
+def appendableWindow(query):
+    """
+    Get the length of the time range of a query ending at now(), when its result can be extended
+    with only the new rows, else None.
+    """
+    predicates = AGO_PREDICATE.findall(query)
+    if len(predicates) != 1 or NOT_APPENDABLE.search(query):
+        return None
+    _, amount, unit = predicates[0]
+    if unit == "ns":
+        return datetime.timedelta(microseconds=int(amount) / 1000)
+    return datetime.timedelta(**{AGO_UNITS[unit]: int(amount)})
+
+def extendableWindow(query):
+    """
+    Get the window of appendableWindow when the query also selects the time of its rows,
+    which is needed to drop the old rows of a cached result, else None.
+    """
+    match = SELECT_LIST.match(query)
+    if match == None or not any(column.strip().lower() in ("*", "time") for column in match.group(1).split(",")):
+        return None
+    return appendableWindow(query)
+
+def restrictTime(query, start, end = None, keepOperator = False):
+    """
+    Replace the `time > ago(...)` predicate of a query with the range (start, end], open ended when end is None.
+    With keepOperator, a `time >= ago(...)` predicate gives the range [start, end] instead.
+    """
+    def epochMillis(value):
+        return int((value - datetime.datetime(1970, 1, 1)).total_seconds() * 1000)
+    def replace(match):
+        if keepOperator:
+            predicate = match.group(0).replace(match.group(1), "from_milliseconds({})".format(epochMillis(start)))
+        else:
+            ## The rows at start belong to the range before it, so they are not fetched twice
+            predicate = "time > from_milliseconds({})".format(epochMillis(start))
+        if end == None:
+            return predicate
+        return "({} AND time <= from_milliseconds({}))".format(predicate, epochMillis(end))
+    return AGO_PREDICATE.sub(replace, query)
+
+class QueryCache:
+    """
+    Cache of query results, stored as parquet files in a local directory.
+
+    Results are fetched again after ttl seconds. Until then, the result of a query ending at
+    now(), like `SELECT time, x ... WHERE time > ago(60d)`, is extended with the rows after the last fetch,
+    from `overlap` before it to include late arriving rows, and the rows older than the range are dropped.
+    Other queries using ago() or now(), like aggregations, are keyed by the bucket of time they were
+    executed in, so their result is fetched again in the next bucket.
+    The least recently used results are removed when the files take more than maxBytes.
+    """
+    def __init__(self, directory, ttl = 24 * 3600, maxBytes = 512 * 2**20, overlap = datetime.timedelta(hours=1),
+                 bucket = datetime.timedelta(hours=1)):
+        self.directory = directory
+        self.ttl = ttl
+        self.maxBytes = maxBytes
+        self.overlap = overlap
+        self.bucket = bucket
+        os.makedirs(directory, exist_ok=True)
+        self.index = FileStateStore(os.path.join(directory, "index.json"))
+
+    def key(self, query, now = None):
+        """
+        Get the key of a query, with the start of the bucket of now for the queries using ago() or now()
+        which are not extended with the new rows.
+        """
+        text = normalizeQuery(query)
+        if now != None and RELATIVE_TIME.search(query) and extendableWindow(query) == None:
+            epoch = datetime.datetime(1970, 1, 1)
+            text = "{}\n{}".format(text, (now - (now - epoch) % self.bucket).isoformat())
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, "{}.parquet".format(key))
+
+    def load(self, key):
+        """
+        Get the cached result and its entry, or (None, None) when it is missing or expired.
+        """
+        entries = self.index.get("entries", {})
+        entry = entries.get(key)
+        if entry == None or time.time() - entry['fetched'] > self.ttl or not os.path.exists(self.path(key)):
+            return None, None
+        entries[key] = dict(entry, used=time.time())
+        self.index.update({"entries": entries})
+        return pd.read_parquet(self.path(key)), entry
+
+    def store(self, key, query, df, end, fetched = None):
+        """
+        Store a result, which covers the rows up to end, and evict the least recently used results.
+        """
+        tmpPath = "{}.tmp".format(self.path(key))
+        try:
+            df.to_parquet(tmpPath)
+        except Exception as e:
+            print("Not caching the result of the query: {}".format(e))
+            return
+        os.replace(tmpPath, self.path(key))
+        entries = self.index.get("entries", {})
+        entries[key] = {'query': normalizeQuery(query), 'fetched': fetched or time.time(), 'used': time.time(),
+                        'end': end.isoformat(), 'bytes': os.path.getsize(self.path(key))}
+        total = sum(entry['bytes'] for entry in entries.values())
+        for oldKey in sorted(entries, key=lambda k: entries[k]['used']):
+            if total <= self.maxBytes:
+                break
+            total -= entries.pop(oldKey)['bytes']
+            os.remove(self.path(oldKey))
+        self.index.update({"entries": entries})
+
+def executeCachedQuery(client, cache, query, timing = False, logFile = None, slices = 1):
+    """
+    Execute the passed query, using the results in the cache when they are still valid.
+    A query which is not cached is split in the given number of slices, see executeSlicedQuery.
+    """
+    ## Timestream returns the time in UTC, without a timezone
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    key = cache.key(query, now)
+    cached, entry = cache.load(key)
+    window = extendableWindow(query)
+    if cached is not None and window == None:
+        print("Using the cached result of the query")
+        return cached
+    ## A result without columns has no rows to extend, it is fetched again
+    if cached is not None and 'time' in cached.columns:
+        since = datetime.datetime.fromisoformat(entry['end']) - cache.overlap
+        tailQuery = restrictTime(query, since)
+        print("Fetching the rows since {} of the cached query".format(since))
+        tail = executeQueryAndReturnAsDataframe(client, tailQuery, timing, logFile)
+        times = pd.to_datetime(cached['time'])
+        cached = cached[(times > now - window) & (times <= since)]
+        df = pd.concat([cached, tail], ignore_index=True) if len(tail) else cached.reset_index(drop=True)
+        cache.store(key, query, df, now, entry['fetched'])
+        return df
+    df = executeSlicedQuery(client, query, slices, timing, logFile)
+    cache.store(key, query, df, now)
     return df
 
 ## Execute the passed query using the client and return the result
 ## as a dataframe.
 def executeQueryAndReturnAsDataframe(client, query, timing = False, logFile = None):
-    return flatModelToDataframe(executeQuery(client, query, timing, logFile))
+    return flatModelToDataframe(iterateQuery(client, query, timing, logFile))
+
+## Execute the passed query using the client and yield the result
+## as a dataframe per page, while the next pages are being fetched.
+def executeQueryAndIterateDataframes(client, query, timing = False, logFile = None):
+    return iterateDataframes(iterateQuery(client, query, timing, logFile))
+
+SliceResult = namedtuple('SliceResult', ['frames', 'rows', 'pages', 'time', 'firstResult'])
+
+def executeSlice(client, query, stop, timing = False, logFile = None):
+    """
+    Execute one slice of a sliced query, stopping and canceling the query when stop is set.
+    """
+    start = timer()
+    firstResult = None
+    frames = []
+    pages = iterateQuery(client, query, timing, logFile)
+    try:
+        for frame in iterateDataframes(pages):
+            if stop.is_set():
+                break
+            if firstResult == None:
+                firstResult = timer() - start
+            frames.append(frame)
+    finally:
+        ## Closing the pages cancels the query when it was stopped before the last page
+        pages.close()
+    return SliceResult(frames, sum(len(frame) for frame in frames), len(frames), timer() - start, firstResult)
+
+## Execute the passed query as the given number of queries over slices of its time range,
+## run in parallel with a shared client, and return the result as a dataframe in the order of the slices.
+## Only queries with a single `time > ago(...)` predicate, no aggregation and no ORDER BY can be sliced,
+## other queries are executed as one query.
+def executeSlicedQuery(client, query, slices = 8, timing = False, logFile = None):
+    window = appendableWindow(query)
+    if slices <= 1 or window == None:
+        if slices > 1:
+            print("The query can not be split by time, executing it as one query")
+        return executeQueryAndReturnAsDataframe(client, query, timing, logFile)
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    bounds = [now - window + window * i / slices for i in range(slices)] + [None]
+    ## The first slice starts as the original query and the last slice is open ended, as the original query.
+    ## The other slices exclude their start, which is the end of the slice before them
+    sliceQueries = [restrictTime(query, sliceStart, sliceEnd, keepOperator=i == 0)
+                    for i, (sliceStart, sliceEnd) in enumerate(zip(bounds, bounds[1:]))]
+    stop = threading.Event()
+    start = timer()
+    with ThreadPoolExecutor(max_workers=slices) as executor:
+        futures = [executor.submit(executeSlice, client, sliceQuery, stop, timing, logFile) for sliceQuery in sliceQueries]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except (Exception, KeyboardInterrupt):
+            ## Stop the slices still running, which cancel their queries
+            print("Canceling the remaining slices")
+            stop.set()
+            for future in futures:
+                future.cancel()
+            raise
+    results = [future.result() for future in futures]
+    end = timer()
+
+    if timing == True:
+        messages = ["Slice {}/{}: {} rows in {} pages. Time: {}. First result: {}.".format(
+            i + 1, slices, result.rows, result.pages, round(result.time, 3),
+            round(result.firstResult, 3) if result.firstResult != None else None) for i, result in enumerate(results)]
+        rows = sum(result.rows for result in results)
+        messages.append("Sliced query: {} rows in {} slices. Time: {}. Slowest slice: {}. Rows per second: {}.".format(
+            rows, slices, round(end - start, 3), round(max(result.time for result in results), 3), round(rows / (end - start))))
+        for message in messages:
+            print(message)
+            if logFile != None:
+                logFile.write("{}\n".format(message))
+
+    frames = [frame for result in results for frame in result.frames]
+    if len(frames) == 0:
+        return pd.DataFrame()
+    ## Slices without rows give an empty frame with the columns, only needed when all slices are empty
+    return pd.concat([frame for frame in frames if len(frame) > 0] or frames[:1], ignore_index=True)
 
 ## Executed the passed query using the specified client.
 ## logFile is a file handle which if initialized is assumed to be a valid file handle
 ## where messages will be written. The file handle is expected to have been opened
 ## by the caller. This function does not close the handle and passes it back to the caller.
 def executeQuery(client, query, timing = False, logFile = None):
+    return list(iterateQuery(client, query, timing, logFile))
+
+def cancelQuery(client, queryId):
+    if queryId != None:
+        ## Try canceling the query if it is still running
+        print("Attempting to cancel query: {}".format(queryId))
+        try:
+            client.cancel_query(QueryId=queryId)
+        except:
+            pass
+
+## Execute the passed query using the specified client, yielding the pages with
+## rows as they are received. If there were no rows, the last empty page is yielded.
+def iterateQuery(client, query, timing = False, logFile = None):
     try:
-        pages = None
         queryId = None
         firstResult = None
         start = timer()
@@ -115,7 +465,6 @@ def executeQuery(client, query, timing = False, logFile = None):
         paginator = client.get_paginator('query')
         pageIterator = paginator.paginate(QueryString=query)
         emptyPages = 0
-        pages = list()
         lastPage = None
         for page in pageIterator:
             if 'QueryId' in page and queryId == None:
@@ -128,41 +477,29 @@ def executeQuery(client, query, timing = False, logFile = None):
                 ## We got an empty page.
                 emptyPages +=1
             else:
-                pages.append(page)
                 if firstResult == None:
                     ## Note the time when the first row of result was received.
                     firstResult = timer()
+                yield page
 
         ## If there were no result, then return the last empty page to carry over the query results context
-        if len(pages) == 0 and lastPage != None:
-            pages.append(lastPage)
-        return pages
+        if firstResult == None and lastPage != None:
+            yield lastPage
     except Exception as e:
-        if queryId != None:
-            ## Try canceling the query if it is still running
-            print("Attempting to cancel query: {}".format(queryId))
-            try:
-                client.cancel_query(query_id=queryId)
-            except:
-                pass
+        cancelQuery(client, queryId)
         print(e)
         exc_type, exc_value, exc_traceback = sys.exc_info()
         traceback.print_exception(exc_type, exc_value, exc_traceback, limit=2, file=sys.stdout)
-        if e.response != None:
+        if getattr(e, 'response', None) != None:
             queryId = None
             print("RequestId: {}".format(e.response['ResponseMetadata']['RequestId']))
             if 'QueryId' in e.response:
                 queryId = e.response['QueryId']
             print("QueryId: {}".format(queryId))
         raise e
-    except KeyboardInterrupt:
-        if queryId != None:
-            ## Try canceling the query if it is still running
-            print("Attempting to cancel query: {}".format(queryId))
-            try:
-                client.cancel_query(query_id=queryId)
-            except:
-                pass
+    except (KeyboardInterrupt, GeneratorExit):
+        ## GeneratorExit is raised when the caller stops reading the pages
+        cancelQuery(client, queryId)
         raise
     finally:
         end = timer()
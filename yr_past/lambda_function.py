@@ -1,12 +1,14 @@
 import os
-import requests
 import datetime as dt
 import json
-import boto3
 import math
 from dotenv import load_dotenv
-import pandas as pd
-import numpy as np
+from common import http_client, metrics
+from common.fetch import fetch_concurrently
+from common.pipeline import BatchPipeline
+from common.records import Record
+from common.sinks import open_sink
+from common.timestamps import iso_to_epoch_ms
 
 
 load_dotenv()
@@ -16,48 +18,87 @@ TIMESTREAM_DATATYPES = ("DOUBLE", "BIGINT", "VARCHAR", "BOOLEAN")
 DATABASE_NAME = os.getenv("DATABASE_NAME")
 TABLE_NAME = os.getenv("TABLE_NAME")
 CLIENT_ID = os.getenv("CLIENT_ID")
+# Url of the FROST observations API, can be overridden to run against a local server
+FROST_URL = os.getenv("FROST_URL", "https://frost.met.no/observations/v0.jsonld")
+# Number of met-stations fetched in a single request
+STATIONS_PER_REQUEST = int(os.getenv("STATIONS_PER_REQUEST") or 20)
+# Maximum number of requests to FROST at the same time
+MAX_IN_FLIGHT = int(os.getenv("MAX_IN_FLIGHT") or 4)
+# Maximum number of requests per second to FROST, lowered while it answers 429 Too Many Requests
+REQUESTS_PER_SECOND = float(os.getenv("REQUESTS_PER_SECOND") or 20)
+# Where the records are written, timestream or parquet:<directory>
+SINK = os.getenv("SINK", "timestream")
 
 assert DATABASE_NAME
 assert TABLE_NAME
 assert CLIENT_ID
 
-def get_measurement(data: pd.Series):
-    measurements = []
-    for name in data.index:
-        if name != "max_wind_speed(wind_from_direction PT1H)":
-            if data.name != np.nan:
-                measurements.append({
-                    "Name": name,
-                    "Value": str(data[name]),
-                    "Type": "DOUBLE"
-                })
-    if "max_wind_speed(wind_from_direction PT1H)" in data.index:
-        # wind direction is set together of sin and cos to avoid 359 -> 0 
-        wind_direction = float(data["max_wind_speed(wind_from_direction PT1H)"])
-        if wind_direction != np.nan:
-            cos_val = math.cos(math.radians(wind_direction))
-            sin_val = math.sin(math.radians(wind_direction))
-            measurements.append({
-                "Name": f"wind_direction_cos",
-                "Value": str(cos_val),
-                "Type": "DOUBLE"
-            })
-            measurements.append({
-                "Name": f"wind_direction_sin",
-                "Value": str(sin_val),
-                "Type": "DOUBLE"
-            })
-    return measurements
-
-def get_and_extract_yr_data(lat: float, lon: float, gateway_id: int, measure_station: str):
-    """Gets the historical data from yr.no by using the FROST API,
-    and returns the rows to be inserted to the timestream database
-
-    :param lat: Lat of the gateway, to be stored in the database. Future usage: lat for dynamically getting the source-id of the met-station
-    :param lon: Lon of the gateway, to be stored in the database. Future usage: lon for dynamically getting the source-id of the met-station
-    :param gateway_id: Gateway id to be stored in the database
-    :param measure_station: id of met-station. Can be found via the FROST API at https://frost.met.no/sources/v0.jsonld
-    :return: rows to be inserted into database
+WIND_DIRECTION = "max_wind_speed(wind_from_direction PT1H)"
+
+# Positions from yr_position.json, loaded once per lambda container
+_positions = None
+
+def frost_to_rows(data):
+    """Pivot the observations from the FROST API into a row of values per timestamp
+
+    :param data: the `data` list of a FROST observations response
+    :return: tuple of the sorted timestamps in epoch ms, the sorted element ids and a
+        list of values per timestamp, in the order of the element ids and None where
+        an element has no value
+    """
+    observations = {}
+    for item in data:
+        row = observations.setdefault(iso_to_epoch_ms(item['referenceTime']), {})
+        for observation in item['observations']:
+            row[observation['elementId']] = observation['value']
+    names = sorted({name for row in observations.values() for name in row})
+    times = sorted(observations)
+    return times, names, [[observations[time].get(name) for name in names] for time in times]
+
+def extract_frost_records(rows, lat: float, lon: float, gateway_id: int):
+    """Build the timestream records from the rows of observations
+
+    Measures without a value are left out, and a timestamp without any values gives no record.
+
+    :param rows: tuple from `frost_to_rows`
+    :return: generator of rows to be inserted into database
+    """
+    times, elements, values = rows
+    names = [name for name in elements if name != WIND_DIRECTION]
+    wind_direction = elements.index(WIND_DIRECTION) if WIND_DIRECTION in elements else None
+    if wind_direction is not None:
+        # wind direction is set together of sin and cos to avoid 359 -> 0
+        names += ["wind_direction_cos", "wind_direction_sin"]
+
+    dimensions = [
+        {'Name': 'lat', 'Value': str(lat)},
+        {'Name': 'lon', 'Value': str(lon)},
+        {'Name': 'gateway_id', 'Value': str(gateway_id)},
+    ]
+    # Rows with the same measures present share the names and types of their measures
+    measures_by_present = {}
+    for time, row in zip(times, values):
+        row_values = [float(value) if value is not None else None
+                      for index, value in enumerate(row) if index != wind_direction]
+        if wind_direction is not None:
+            direction = row[wind_direction]
+            radians = math.radians(direction) if direction is not None else None
+            row_values += [math.cos(radians), math.sin(radians)] if radians is not None else [None, None]
+        row_present = tuple(value is not None for value in row_values)
+        if not any(row_present):
+            continue
+        measures = measures_by_present.get(row_present)
+        if measures is None:
+            measures = measures_by_present[row_present] = tuple(
+                (name, "DOUBLE") for name, is_present in zip(names, row_present) if is_present)
+        yield Record(dimensions, time, 'yr_past', measures,
+                     tuple(value for value in row_values if value is not None))
+
+def get_frost_observations(measure_stations):
+    """Gets the historical data of several met-stations from yr.no in a single request to the FROST API
+
+    :param measure_stations: ids of met-stations. Can be found via the FROST API at https://frost.met.no/sources/v0.jsonld
+    :return: dict from station id to the observations of the station
     """
     client_id = CLIENT_ID
     # api endpoint for getting the sources if that is needed
@@ -67,83 +108,73 @@ def get_and_extract_yr_data(lat: float, lon: float, gateway_id: int, measure_sta
     # This is done to avoid gaps at 23-00 
     tomorrow = dt.date.today() + dt.timedelta(days=1)
     yesterday = dt.date.today() - dt.timedelta(days=1)
-    endpoint = 'https://frost.met.no/observations/v0.jsonld'
+    endpoint = FROST_URL
     parameters = {
-        'sources': measure_station,
+        'sources': ','.join(measure_stations),
         'elements': 'sum(precipitation_amount PT1H),max(air_temperature PT1H),max(wind_speed PT1H),max_wind_speed(wind_from_direction PT1H), ',
         'referencetime': f'{yesterday.isoformat()}/{tomorrow.isoformat()}',
     }
-    r = requests.get(endpoint, parameters, auth=(client_id,''))
-    json_data = r.json()
+    key = ','.join(measure_stations)
+    with metrics.timer("fetch", key):
+        r = http_client.get(endpoint, parameters, auth=(client_id,''), requests_per_second=REQUESTS_PER_SECOND)
+    # FROST answers 404 when none of the stations has data in the period
+    if r.status_code == 404:
+        return {}
+    r.raise_for_status()
+    with metrics.timer("parse", key):
+        json_data = r.json()
     data = json_data['data']
 
-    # get all observations and the time
-    df = pd.json_normalize(data, record_path=['observations'], meta='referenceTime')
-    df = df[['referenceTime','value', 'elementId']].rename(columns={'referenceTime':'timestamp'})
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
-
-    # reset table structure so that the columns is the values of the sensors and the
-    # index is the timestamp.
-    df = df.pivot(index='timestamp', columns='elementId', values='value').reset_index()
-    df.set_index('timestamp', inplace=True)
-
-    # add all columns as columns in the timestream database
-    records = []
-    measure_values = []
-    for timestamp, row in df.iterrows():
-        measure_values = get_measurement(data=row)
-        record = {
-            'Dimensions': [
-                {'Name': 'lat', 'Value': str(lat)},
-                {'Name': 'lon', 'Value': str(lon)},
-                {'Name': 'gateway_id', 'Value': str(gateway_id)},
-
-            ],
-            'Time': str(int(timestamp.timestamp()*1000)),
-            'MeasureName': 'yr_past',
-            'MeasureValueType': 'MULTI',
-            'MeasureValues': measure_values
-        }
-        if len(measure_values) != 0:
-            records.append(record)
-    # print(record)
-    return records
+    # the source id is the station id followed by the sensor system, e.g. SN68860:0
+    observations = {}
+    for item in data:
+        observations.setdefault(item['sourceId'].split(':')[0], []).append(item)
+    return observations
+
 
+def load_positions():
+    """Load the positions to get yr data from, once per lambda container"""
+    global _positions
+    if _positions is None:
+        with open("yr_position.json") as positions:
+            _positions = json.load(positions)
+    return _positions
 
 def fetch_and_insert_sensor_data(names=None):
-    # load positions to get yr data from
-    positions = open("yr_position.json")
-    schema = json.load(positions)
-    records = []
-
-    for point in schema:
-        # for cli usage for one or multiple points
-        if names is not None and point['name'] not in names:
-            continue
-        else:
-            records += get_and_extract_yr_data(
-                lat=point['lat'], 
-                lon=point['lon'], 
-                gateway_id=point['gatewayId'], 
-                measure_station=point['measureStation'])
-    if len(records) == 0:
+    # for cli usage for one or multiple points
+    points = [point for point in load_positions() if names is None or point['name'] in names]
+    # each station is fetched once, and its data is used for every gateway using it
+    points_by_station = {}
+    for point in points:
+        points_by_station.setdefault(point['measureStation'], []).append(point)
+    stations = list(points_by_station)
+    station_groups = [stations[i: i + STATIONS_PER_REQUEST] for i in range(0, len(stations), STATIONS_PER_REQUEST)]
+
+    # the version makes a new run overwrite the previous values at the same time
+    writer = open_sink(SINK, DATABASE_NAME, TABLE_NAME, source="yr_past", device_dimension="gateway_id",
+                       common_attributes=lambda: {'Version': round(dt.datetime.now().timestamp())})
+    # batches are written while the next groups of stations are fetched
+    with writer, BatchPipeline(writer.submit) as pipeline:
+        for group, observations, err in fetch_concurrently(get_frost_observations, station_groups, max_in_flight=MAX_IN_FLIGHT):
+            if err is not None:
+                print(f"Error fetching stations {','.join(group)}:", err)
+                metrics.count("fetch_errors")
+                continue
+            for station, data in observations.items():
+                with metrics.timer("transform", station):
+                    rows = frost_to_rows(data)
+                for point in points_by_station.get(station, []):
+                    records = extract_frost_records(rows, lat=point['lat'], lon=point['lon'], gateway_id=point['gatewayId'])
+                    pipeline.extend(metrics.timed("transform", station, records))
+    print("WriteRecords Summary:", writer.summary)
+    metrics.record_summary(writer.summary, pipeline.count)
+    if pipeline.count == 0:
         raise ValueError("The specified ids has no matching schemas.")
-
-    client = boto3.client("timestream-write")
-    for window_i in range(0, len(records), 100):
-        record_window = records[window_i: window_i + 100]
-        try:
-            result = client.write_records(DatabaseName=DATABASE_NAME, TableName=TABLE_NAME,
-                                                Records=record_window, CommonAttributes={'Version': round(dt.datetime.now().timestamp())})
-            print("WriteRecords Status: [%s]" % result['ResponseMetadata']['HTTPStatusCode'])
-        except client.exceptions.RejectedRecordsException as err:
-            print(err.response)
-        except Exception as err:
-            print("Error:", err)
  
 def lambda_handler(event=None, context=None):
-    """Handler for lambda function"""
-    fetch_and_insert_sensor_data()
+    """Handler for lambda function, logging the timings and counts of the invocation when it ends"""
+    with metrics.invocation("yr_past", breakdown="stations"):
+        fetch_and_insert_sensor_data()
     
 
 if __name__ == "__main__":